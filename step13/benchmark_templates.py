@@ -0,0 +1,67 @@
+#!python3
+"""Compare how quickly a table of bookings is rendered the old way --
+adding each row's HTML onto the end of one string with str.format --
+and with the compiled templates in bookings.py.
+
+    python benchmark_templates.py [n_rows]
+"""
+import sqlite3
+import sys
+import timeit
+
+import bookings
+
+def make_rows(n_rows):
+    """Make n_rows rows which look like the ones read from v_bookings
+    """
+    db = sqlite3.connect(":memory:")
+    db.row_factory = sqlite3.Row
+    db.execute("""
+    CREATE TABLE v_bookings
+    (
+        user_name, room_name, booked_on, booked_from, booked_to
+    )""")
+    db.executemany(
+        "INSERT INTO v_bookings VALUES(?, ?, ?, ?, ?)",
+        (
+            ("User %d" % n, "Room %d" % (n % 50), "2014-11-18", "09:00" if n % 3 else None, "10:00" if n % 2 else None)
+            for n in range(n_rows)
+        )
+    )
+    return db.execute("SELECT * FROM v_bookings").fetchall()
+
+def render_before(rows):
+    """The way all_bookings_page used to build its table
+    """
+    html = "<table>"
+    html += "<tr><td>Room</td><td>User</td><td>Date</td><td>Times</td></tr>"
+    for booking in rows:
+        html += "<tr><td>{user_name}</td><td>{room_name}</td><td>{booked_on}</td><td>{booked_from} - {booked_to}</td></tr>".format(
+            user_name=booking['user_name'],
+            room_name=booking['room_name'],
+            booked_on=booking['booked_on'],
+            booked_from=booking['booked_from'] or "",
+            booked_to=booking['booked_to'] or ""
+        )
+    html += "</table>"
+    return html
+
+def render_after(rows):
+    """The way all_bookings_page builds its table now
+    """
+    html = ["<table>", "<tr><td>Room</td><td>User</td><td>Date</td><td>Times</td></tr>"]
+    html.extend(bookings.ALL_BOOKINGS_ROW.render_many(rows))
+    html.append("</table>")
+    return "".join(html)
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = make_rows(n_rows)
+    assert render_before(rows) == render_after(rows)
+
+    for name, render in [("before", render_before), ("after", render_after)]:
+        #
+        # Take the best of several runs to keep out as much noise as we can
+        #
+        seconds = min(timeit.repeat(lambda: render(rows), number=10, repeat=5)) / 10
+        print("%-6s %8.2f ms per table  %10d rows/s" % (name, seconds * 1000, n_rows / seconds))
@@ -1,10 +1,30 @@
 #!python3
 import os, sys
-import cgi
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import datetime
+import functools
+import heapq
+import html
+import io
+import itertools
+import json
+import queue
+import re
+import signal
+import socketserver
 import sqlite3
-from wsgiref.util import setup_testing_defaults, shift_path_info
-from wsgiref.simple_server import make_server
+import string
+import threading
+import time
+import traceback
+import urllib.parse
+from wsgiref.util import setup_testing_defaults
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 
 #
 # Ensure we're using the same database filename throughout.
@@ -13,46 +33,820 @@ from wsgiref.simple_server import make_server
 #
 DATABASE_FILEPATH = "bookings.db"
 
-def create_database():
-    """Connect to the database, read the CREATE statements and split
-    them at the semicolon into individual statements. Once each
-    statement has been executed, close the connection.
+#
+# How many idle database connections to keep around for re-use, and
+# how long (in seconds) a connection can sit idle before we check it's
+# still usable before handing it out again.
+#
+POOL_SIZE = 5
+POOL_CHECK_AFTER = 30
+
+#
+# How long (in seconds) to wait for another connection to finish
+# writing before giving up with "database is locked".
+#
+BUSY_TIMEOUT = 10
+
+#
+# When adding many rows at once, how many to pass to sqlite at a time.
+# Bigger chunks are (a little) faster but hold more rows in memory.
+#
+BULK_CHUNK_SIZE = 1000
+
+#
+# When reading rows one at a time with iter_select, how many to fetch
+# from sqlite in each go.
+#
+ITER_ARRAYSIZE = 500
+
+class PooledConnection(sqlite3.Connection):
+    """A connection which can remember when it was last used, and
+    which generation of the pool it belongs to
     """
-    #
-    # Since we might be re-running this, delete the file and rebuild
-    # it if necessary.
-    #
-    if os.path.exists(DATABASE_FILEPATH):
-        os.remove(DATABASE_FILEPATH)
+    last_used = 0
+    generation = 0
 
-    #
-    # A database cursor the the Python mechanism for running something
-    # against any database. You create a cursor and then .execute
-    # SQL statements through it.
-    #
-    db = sqlite3.connect(DATABASE_FILEPATH)
-    q = db.cursor()
+def connect():
+    """Open a new connection to the database, ready to hand out from
+    the pool. Rows come back as sqlite3.Row so they can be indexed by
+    column name as well as by position.
 
+    check_same_thread is off because a connection may be returned to
+    the pool by one thread and picked up by another. The pool makes sure
+    only one thread uses a connection at a time.
+    """
+    db = sqlite3.connect(
+        DATABASE_FILEPATH,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False,
+        factory=PooledConnection
+    )
+    db.row_factory = sqlite3.Row
+    return db
+
+class ConnectionPool(object):
+    """Keep a small number of open database connections for re-use
+    so that each query doesn't pay for connecting to (and parsing the
+    schema of) the database file all over again.
+
+    Up to `size` idle connections are kept; any more than that are
+    closed when they're given back. The one given back most recently is
+    handed out first, so a thread which gives a connection back and
+    then asks for one usually gets the same one again. (Connections
+    aren't kept for a particular thread: with a thread per request, the
+    thread would be gone before it could use its connection again.)
+
+    `hits` counts the times an existing connection was re-used and
+    `misses` the times a new one had to be opened.
+    """
+
+    def __init__(self, connect, size=POOL_SIZE, check_after=POOL_CHECK_AFTER):
+        self.connect = connect
+        self.size = size
+        self.check_after = check_after
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Hand out a healthy connection, preferring an idle one and
+        only then opening a new one
+        """
+        while True:
+            with self._lock:
+                db = self._idle.pop() if self._idle else None
+            if db is None:
+                break
+            if self.is_healthy(db):
+                with self._lock:
+                    self.hits += 1
+                return db
+            self.discard(db)
+
+        with self._lock:
+            self.misses += 1
+        db = self.connect()
+        db.last_used = time.time()
+        db.generation = self.generation
+        return db
+
+    def release(self, db):
+        """Give a connection back. Anything left uncommitted is rolled
+        back so the next user starts with a clean slate.
+        """
+        try:
+            db.rollback()
+        except sqlite3.Error:
+            self.discard(db)
+            return
+        db.last_used = time.time()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(db)
+                return
+        self.discard(db)
+
+    def is_healthy(self, db):
+        """A connection which has been used recently is assumed to be
+        fine; one which has been sitting idle is checked with a trivial
+        query before being handed out. Connections opened before the
+        pool was last cleared out are never re-used.
+        """
+        if db.generation != self.generation:
+            return False
+        if time.time() - db.last_used < self.check_after:
+            return True
+        try:
+            db.execute("SELECT 1").fetchall()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def discard(self, db):
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """Close every idle connection, eg because the database file is
+        about to be replaced. Connections currently in use are closed
+        when they're next picked up.
+        """
+        with self._lock:
+            self.generation += 1
+            idle, self._idle = self._idle, []
+        for db in idle:
+            self.discard(db)
+
+    def stats(self):
+        """Return a dictionary of hits, misses and the hit rate
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                idle=len(self._idle),
+                hit_rate=float(self.hits) / total if total else 0.0
+            )
+
+POOL = ConnectionPool(connect)
+
+#
+# While a web request is being served, the connection it's reading
+# through is kept here so every select() made for that request sees
+# the same snapshot of the database.
+#
+_request = threading.local()
+
+@contextlib.contextmanager
+def request_context(snapshot=True):
+    """Take one connection from the pool for the whole of a request and
+    start a read transaction on it. Every select() within the request
+    goes through that connection, so all the queries for a page see
+    the database as it was at the first of them, even if someone else
+    adds a booking half-way through.
+
+    Requests which write (the POST handlers) pass snapshot=False and
+    carry on using a connection per statement.
+    """
+    if not snapshot or getattr(_request, "db", None) is not None:
+        yield
+        return
+
+    db = POOL.acquire()
+    db.execute("BEGIN")
+    _request.db = db
+    try:
+        yield
+    finally:
+        _request.db = None
+        #
+        # Releasing the connection rolls back, which ends the (read-only)
+        # transaction.
+        #
+        POOL.release(db)
+
+@contextlib.contextmanager
+def outside_request():
+    """Within this, select() takes connections from the pool as it would
+    outside a request, and so sees the database as it is now rather
+    than as it was when the request's snapshot was taken.
+    """
+    request_db = getattr(_request, "db", None)
+    _request.db = None
+    try:
+        yield
+    finally:
+        _request.db = request_db
+
+#
+# Each migration takes the database from the version before it to the
+# version given, and is only ever run once against a database. The
+# version a database has reached is kept in sqlite's user_version
+# header field. A database made before versions were recorded is
+# treated as version 1 (the original create.sql). A migration is a
+# script of SQL statements, or a function which is passed the database
+# connection for anything SQL can't easily do by itself.
+#
+# create.sql always describes the latest version in full, so a brand
+# new database is made from that directly, without any migrations.
+# When you add a migration here, make the same change to create.sql.
+#
+MIGRATIONS = [
+    (2, "Primary key and indexes for bookings", """
+    DROP VIEW v_bookings;
+
+    CREATE TABLE
+        bookings_new
+    (
+        id INTEGER PRIMARY KEY NOT NULL,
+        user_id INTEGER NOT NULL,
+        room_id INTEGER NOT NULL,
+        booked_on DATE NOT NULL,
+        booked_from TIME NULL,
+        booked_to TIME NULL
+    );
+
+    INSERT INTO bookings_new(id, user_id, room_id, booked_on, booked_from, booked_to)
+    SELECT rowid, user_id, room_id, booked_on, booked_from, booked_to FROM bookings;
+
+    DROP TABLE bookings;
+    ALTER TABLE bookings_new RENAME TO bookings;
+
+    CREATE INDEX ix_bookings_room ON bookings(room_id, booked_on, booked_from);
+    CREATE INDEX ix_bookings_user ON bookings(user_id, booked_on);
+
+    CREATE VIEW
+        v_bookings
+    AS SELECT
+        boo.id,
+        boo.user_id,
+        usr.name AS user_name,
+        boo.room_id,
+        roo.name AS room_name,
+        boo.booked_on,
+        boo.booked_from,
+        boo.booked_to
+    FROM
+        bookings AS boo
+    JOIN users AS usr ON
+        usr.id = boo.user_id
+    JOIN rooms AS roo ON
+        roo.id = boo.room_id;
+    """),
+    (3, "Prevent overlapping bookings of the same room", """
+    CREATE TRIGGER
+        tr_bookings_no_overlap_insert
+    BEFORE INSERT ON bookings
+    WHEN EXISTS (
+        SELECT 1 FROM bookings AS boo
+        WHERE boo.room_id = NEW.room_id
+        AND boo.booked_on = NEW.booked_on
+        AND COALESCE(NULLIF(boo.booked_from, ''), '00:00') < COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+        AND COALESCE(NULLIF(NEW.booked_from, ''), '00:00') < COALESCE(NULLIF(boo.booked_to, ''), '24:00')
+    )
+    BEGIN
+        SELECT RAISE(ABORT, 'booking conflict');
+    END;
+
+    CREATE TRIGGER
+        tr_bookings_no_overlap_update
+    BEFORE UPDATE OF room_id, booked_on, booked_from, booked_to ON bookings
+    WHEN EXISTS (
+        SELECT 1 FROM bookings AS boo
+        WHERE boo.room_id = NEW.room_id
+        AND boo.booked_on = NEW.booked_on
+        AND boo.id <> NEW.id
+        AND COALESCE(NULLIF(boo.booked_from, ''), '00:00') < COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+        AND COALESCE(NULLIF(NEW.booked_from, ''), '00:00') < COALESCE(NULLIF(boo.booked_to, ''), '24:00')
+    )
+    BEGIN
+        SELECT RAISE(ABORT, 'booking conflict');
+    END;
+    """),
+    (4, "Index bookings by day", """
+    CREATE INDEX ix_bookings_day ON bookings(booked_on, room_id, booked_from, booked_to);
+    """),
+    (5, "Quarter-hour bitmaps of each room's bookings for each day", """
+    --
+    -- Each room's bookings for a day are also kept as a bitmap of the
+    -- day's 96 quarter-hours: a bit is set if the room is booked for any
+    -- part of that quarter-hour. The first 48 quarter-hours (midnight to
+    -- midday) are in early_slots and the rest in late_slots, the first
+    -- quarter-hour in the lowest bit. Whether a room is free at a time,
+    -- or when it's next free, can then be worked out with a few bitwise
+    -- operations. The triggers below keep the bitmaps up to date; they
+    -- can be rebuilt from the bookings at any time.
+    --
+    CREATE TABLE
+        room_day_slots
+    (
+        booked_on DATE NOT NULL,
+        room_id INTEGER NOT NULL,
+        early_slots INTEGER NOT NULL DEFAULT 0,
+        late_slots INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (booked_on, room_id)
+    ) WITHOUT ROWID
+    ;
+
+    CREATE TABLE
+        day_slots
+    (
+        slot INTEGER PRIMARY KEY NOT NULL
+    )
+    ;
+
+    WITH RECURSIVE slots(slot) AS (
+        SELECT 0 UNION ALL SELECT slot + 1 FROM slots WHERE slot < 95
+    )
+    INSERT INTO day_slots(slot) SELECT slot FROM slots
+    ;
+
+    --
+    -- The quarter-hours each booking covers, from first_slot up to (but
+    -- not including) end_slot, and those as bitmaps.
+    --
+    CREATE VIEW
+        v_booking_slots
+    AS SELECT
+        id,
+        room_id,
+        booked_on,
+        first_slot,
+        end_slot,
+        CASE WHEN MIN(end_slot, 48) > first_slot
+            THEN (1 << MIN(end_slot, 48)) - (1 << first_slot)
+            ELSE 0
+        END AS early_mask,
+        CASE WHEN end_slot > MAX(first_slot, 48)
+            THEN (1 << (end_slot - 48)) - (1 << (MAX(first_slot, 48) - 48))
+            ELSE 0
+        END AS late_mask
+    FROM (
+        SELECT
+            id,
+            room_id,
+            booked_on,
+            COALESCE(MIN(MAX((
+                CAST(substr(time_from, 1, instr(time_from, ':') - 1) AS INTEGER) * 60 +
+                CAST(substr(time_from, instr(time_from, ':') + 1, 2) AS INTEGER)
+            ) / 15, 0), 96), 0) AS first_slot,
+            COALESCE(MIN(MAX((
+                CAST(substr(time_to, 1, instr(time_to, ':') - 1) AS INTEGER) * 60 +
+                CAST(substr(time_to, instr(time_to, ':') + 1, 2) AS INTEGER) + 14
+            ) / 15, 0), 96), 96) AS end_slot
+        FROM (
+            SELECT
+                id,
+                room_id,
+                booked_on,
+                NULLIF(booked_from, '') AS time_from,
+                NULLIF(booked_to, '') AS time_to
+            FROM
+                bookings
+        )
+    )
+    ;
+
+    CREATE TRIGGER
+        tr_bookings_slots_insert
+    AFTER INSERT ON bookings
+    BEGIN
+        INSERT OR IGNORE INTO room_day_slots(booked_on, room_id) VALUES(NEW.booked_on, NEW.room_id);
+        UPDATE room_day_slots SET
+            early_slots = early_slots | (SELECT early_mask FROM v_booking_slots WHERE id = NEW.id),
+            late_slots = late_slots | (SELECT late_mask FROM v_booking_slots WHERE id = NEW.id)
+        WHERE booked_on = NEW.booked_on AND room_id = NEW.room_id;
+    END
+    ;
+
+    --
+    -- When a booking is removed or moved, the bitmap for the day it was
+    -- on is worked out again from the room's other bookings that day.
+    --
+    CREATE TRIGGER
+        tr_bookings_slots_delete
+    AFTER DELETE ON bookings
+    BEGIN
+        UPDATE room_day_slots SET
+            early_slots = (
+                SELECT COALESCE(SUM(1 << slot), 0) FROM day_slots
+                WHERE slot < 48 AND EXISTS (
+                    SELECT 1 FROM v_booking_slots AS bs
+                    WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                    AND bs.first_slot <= slot AND slot < bs.end_slot
+                )
+            ),
+            late_slots = (
+                SELECT COALESCE(SUM(1 << (slot - 48)), 0) FROM day_slots
+                WHERE slot >= 48 AND EXISTS (
+                    SELECT 1 FROM v_booking_slots AS bs
+                    WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                    AND bs.first_slot <= slot AND slot < bs.end_slot
+                )
+            )
+        WHERE booked_on = OLD.booked_on AND room_id = OLD.room_id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_bookings_slots_update
+    AFTER UPDATE OF room_id, booked_on, booked_from, booked_to ON bookings
+    BEGIN
+        UPDATE room_day_slots SET
+            early_slots = (
+                SELECT COALESCE(SUM(1 << slot), 0) FROM day_slots
+                WHERE slot < 48 AND EXISTS (
+                    SELECT 1 FROM v_booking_slots AS bs
+                    WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                    AND bs.first_slot <= slot AND slot < bs.end_slot
+                )
+            ),
+            late_slots = (
+                SELECT COALESCE(SUM(1 << (slot - 48)), 0) FROM day_slots
+                WHERE slot >= 48 AND EXISTS (
+                    SELECT 1 FROM v_booking_slots AS bs
+                    WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                    AND bs.first_slot <= slot AND slot < bs.end_slot
+                )
+            )
+        WHERE booked_on = OLD.booked_on AND room_id = OLD.room_id;
+        INSERT OR IGNORE INTO room_day_slots(booked_on, room_id) VALUES(NEW.booked_on, NEW.room_id);
+        UPDATE room_day_slots SET
+            early_slots = early_slots | (SELECT early_mask FROM v_booking_slots WHERE id = NEW.id),
+            late_slots = late_slots | (SELECT late_mask FROM v_booking_slots WHERE id = NEW.id)
+        WHERE booked_on = NEW.booked_on AND room_id = NEW.room_id;
+    END
+    ;
+    """),
+    (6, "Fill in the bitmaps for existing bookings", lambda db: fill_room_day_slots(db)),
+    (7, "Full-text index of bookings, if sqlite has FTS5", lambda db: create_search_index(db)),
+    (8, "Indexes for paging through bookings in date and time order", """
+    CREATE INDEX ix_bookings_when ON bookings(booked_on, booked_from);
+    DROP INDEX ix_bookings_user;
+    CREATE INDEX ix_bookings_user ON bookings(user_id, booked_on, booked_from);
+    """),
+    (9, "A copy of v_bookings as a table, for reading", """
+    --
+    -- A copy of v_bookings kept as a table, with the user's and room's
+    -- names stored alongside each booking, so that listing bookings doesn't
+    -- have to join to users and rooms every time. The triggers below keep
+    -- it in step with bookings, users and rooms. Each index holds every
+    -- column, in the order of one of the listings (all bookings, by room,
+    -- by user), so a page of bookings is read from the index alone. The id
+    -- has to be named to come straight after the time, where the order
+    -- needs it.
+    --
+    CREATE TABLE
+        bookings_read
+    (
+        id INTEGER PRIMARY KEY NOT NULL,
+        user_id INTEGER NOT NULL,
+        user_name VARCHAR(200) NOT NULL,
+        room_id INTEGER NOT NULL,
+        room_name VARCHAR(200) NOT NULL,
+        booked_on DATE NOT NULL,
+        booked_from TIME NULL,
+        booked_to TIME NULL
+    )
+    ;
+
+    CREATE INDEX
+        ix_bookings_read_when
+    ON bookings_read
+    (
+        booked_on, booked_from, id, user_id, user_name, room_id, room_name, booked_to
+    )
+    ;
+
+    CREATE INDEX
+        ix_bookings_read_room
+    ON bookings_read
+    (
+        room_id, booked_on, booked_from, id, user_id, user_name, room_name, booked_to
+    )
+    ;
+
+    CREATE INDEX
+        ix_bookings_read_user
+    ON bookings_read
+    (
+        user_id, booked_on, booked_from, id, user_name, room_id, room_name, booked_to
+    )
+    ;
+
+    CREATE TRIGGER
+        tr_bookings_read_insert
+    AFTER INSERT ON bookings
+    BEGIN
+        INSERT INTO bookings_read SELECT * FROM v_bookings WHERE id = NEW.id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_bookings_read_delete
+    AFTER DELETE ON bookings
+    BEGIN
+        DELETE FROM bookings_read WHERE id = OLD.id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_bookings_read_update
+    AFTER UPDATE ON bookings
+    BEGIN
+        DELETE FROM bookings_read WHERE id = OLD.id;
+        INSERT INTO bookings_read SELECT * FROM v_bookings WHERE id = NEW.id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_users_read_update
+    AFTER UPDATE OF name ON users
+    BEGIN
+        UPDATE bookings_read SET user_name = NEW.name WHERE user_id = NEW.id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_rooms_read_update
+    AFTER UPDATE OF name ON rooms
+    BEGIN
+        UPDATE bookings_read SET room_name = NEW.name WHERE room_id = NEW.id;
+    END
+    ;
+
+    --
+    -- v_bookings only has the bookings whose user and room exist, so the
+    -- same goes for the copy.
+    --
+    CREATE TRIGGER
+        tr_users_read_insert
+    AFTER INSERT ON users
+    BEGIN
+        INSERT OR IGNORE INTO bookings_read SELECT * FROM v_bookings WHERE user_id = NEW.id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_rooms_read_insert
+    AFTER INSERT ON rooms
+    BEGIN
+        INSERT OR IGNORE INTO bookings_read SELECT * FROM v_bookings WHERE room_id = NEW.id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_users_read_delete
+    AFTER DELETE ON users
+    BEGIN
+        DELETE FROM bookings_read WHERE user_id = OLD.id;
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_rooms_read_delete
+    AFTER DELETE ON rooms
+    BEGIN
+        DELETE FROM bookings_read WHERE room_id = OLD.id;
+    END
+    ;
+
+    INSERT INTO bookings_read SELECT * FROM v_bookings;
+    """),
+    (10, "Count changes to users and rooms", """
+    --
+    -- A counter for each of users and rooms, bumped by the triggers below
+    -- whenever anything in that table changes. A process keeping copies of
+    -- users or rooms in memory can tell from these alone whether they're
+    -- still current, without being misled by changes to other tables.
+    --
+    CREATE TABLE
+        table_versions
+    (
+        name VARCHAR(64) PRIMARY KEY NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ;
+
+    INSERT INTO table_versions(name) VALUES('users'), ('rooms')
+    ;
+
+    CREATE TRIGGER
+        tr_users_version_insert
+    AFTER INSERT ON users
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_users_version_update
+    AFTER UPDATE ON users
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_users_version_delete
+    AFTER DELETE ON users
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_rooms_version_insert
+    AFTER INSERT ON rooms
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = 'rooms';
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_rooms_version_update
+    AFTER UPDATE ON rooms
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = 'rooms';
+    END
+    ;
+
+    CREATE TRIGGER
+        tr_rooms_version_delete
+    AFTER DELETE ON rooms
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = 'rooms';
+    END
+    ;
+    """),
+    (11, "Index bookings whose user or room is added after them", lambda db: add_search_index_arrivals(db)),
+    (12, "Refuse bookings which end before they start", """
+    CREATE TRIGGER
+        tr_bookings_times_insert
+    BEFORE INSERT ON bookings
+    WHEN COALESCE(NULLIF(NEW.booked_from, ''), '00:00') >= COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+    BEGIN
+        SELECT RAISE(ABORT, 'booking times backwards');
+    END;
+
+    CREATE TRIGGER
+        tr_bookings_times_update
+    BEFORE UPDATE OF booked_from, booked_to ON bookings
+    WHEN COALESCE(NULLIF(NEW.booked_from, ''), '00:00') >= COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+    BEGIN
+        SELECT RAISE(ABORT, 'booking times backwards');
+    END;
+    """),    (13, "Refuse booking times which aren't HH:MM", """
+    CREATE TRIGGER
+        tr_bookings_time_format_insert
+    BEFORE INSERT ON bookings
+    WHEN NOT (
+        COALESCE(NEW.booked_from, '') IN ('', '24:00')
+        OR NEW.booked_from GLOB '[01][0-9]:[0-5][0-9]'
+        OR NEW.booked_from GLOB '2[0-3]:[0-5][0-9]'
+    ) OR NOT (
+        COALESCE(NEW.booked_to, '') IN ('', '24:00')
+        OR NEW.booked_to GLOB '[01][0-9]:[0-5][0-9]'
+        OR NEW.booked_to GLOB '2[0-3]:[0-5][0-9]'
+    )
+    BEGIN
+        SELECT RAISE(ABORT, 'booking times unreadable');
+    END;
+
+    CREATE TRIGGER
+        tr_bookings_time_format_update
+    BEFORE UPDATE OF booked_from, booked_to ON bookings
+    WHEN NOT (
+        COALESCE(NEW.booked_from, '') IN ('', '24:00')
+        OR NEW.booked_from GLOB '[01][0-9]:[0-5][0-9]'
+        OR NEW.booked_from GLOB '2[0-3]:[0-5][0-9]'
+    ) OR NOT (
+        COALESCE(NEW.booked_to, '') IN ('', '24:00')
+        OR NEW.booked_to GLOB '[01][0-9]:[0-5][0-9]'
+        OR NEW.booked_to GLOB '2[0-3]:[0-5][0-9]'
+    )
+    BEGIN
+        SELECT RAISE(ABORT, 'booking times unreadable');
+    END;
+    """),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def split_statements(sql):
+    """Split a script into individual statements. Rather than breaking
+    naively at every semicolon (which would go wrong with a semicolon
+    inside a string or a trigger), let sqlite tell us when we've read
+    a complete statement.
+    """
+    statement = ""
+    for line in sql.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            if statement.strip(" \t\r\n;"):
+                yield statement
+            statement = ""
+    if statement.strip(" \t\r\n;"):
+        yield statement
+
+def get_schema_version(db):
+    """Work out which version of the schema a database is at
+    """
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version:
+        return version
+    tables = db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+    if not tables:
+        return 0
     #
-    # Read all the contents of create.sql in one gulp
-    #
-    sql = open("create.sql").read()
-    #
-    # Split it into individual statements, breaking on the semicolon
+    # The database was made before versions were recorded. If the
+    # bookings table already has its primary key then it came from a
+    # create.sql which included that; otherwise it's the original.
     #
-    statements = sql.split(";")
+    columns = [row[1] for row in db.execute("PRAGMA table_info(bookings)")]
+    if "id" in columns:
+        return 2
+    return 1
+
+def create_database(rebuild=False):
+    """Make sure the database exists and is at the latest version of
+    the schema. An empty database is created from create.sql; an older
+    one has just the migrations it hasn't yet had applied, all in one
+    transaction, so it's either brought fully up to date or left as
+    it was. A database which is already up to date isn't touched.
+
+    Pass rebuild=True to throw away any existing database and start
+    again from scratch.
+
+    Return True if a new, empty, database was created.
+    """
+    if rebuild:
+        #
+        # Any pooled connections would still be pointing at the old file.
+        #
+        POOL.close_all()
+        if os.path.exists(DATABASE_FILEPATH):
+            os.remove(DATABASE_FILEPATH)
+
     #
-    # Execute each of the individual statements against the database
+    # isolation_level=None stops the sqlite3 module from starting and
+    # committing transactions behind our backs: we say exactly where
+    # the transaction begins and ends.
     #
-    for statement in statements:
-        q.execute(statement)
+    db = sqlite3.connect(DATABASE_FILEPATH, isolation_level=None)
+    try:
+        #
+        # The quick check: most of the time there's nothing to do
+        #
+        if db.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+            return False
+
+        #
+        # BEGIN IMMEDIATE takes the write lock straight away so that two
+        # processes starting at once can't both try to migrate. Once we
+        # have it, check the version again in case the other one won.
+        #
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version = get_schema_version(db)
+            if version == 0:
+                #
+                # The full-text index isn't in create.sql because not
+                # every build of sqlite can make one.
+                #
+                steps = [open("create.sql").read(), create_search_index]
+            else:
+                steps = [
+                    migration for (to_version, description, migration) in MIGRATIONS
+                    if to_version > version
+                ]
+            #
+            # Most migrations are SQL, but one which is easier to write in
+            # Python is a function, which is passed the database connection.
+            #
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    for statement in split_statements(step):
+                        db.execute(statement)
+            db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+    finally:
+        db.close()
 
     #
-    # Close everything
+    # Pooled connections may have cached the old layout of the tables.
     #
-    q.close()
-    db.commit()
-    db.close()
+    POOL.close_all()
+    return version == 0
 
 def populate_database():
     """Populate the database with some valid test data
@@ -97,66 +891,520 @@ def select(sql_statement, params=None):
     """
     if params is None:
         params = []
-    db = sqlite3.connect(DATABASE_FILEPATH)
-    db.row_factory = sqlite3.Row
+    #
+    # If we're in the middle of a web request, use its connection
+    # rather than taking another one from the pool.
+    #
+    request_db = getattr(_request, "db", None)
+    db = request_db if request_db is not None else POOL.acquire()
     q = db.cursor()
     try:
         q.execute(sql_statement, params)
         return q.fetchall()
     finally:
         q.close()
-        db.close()
+        if request_db is None:
+            POOL.release(db)
+
+def iter_select(sql_statement, params=None, arraysize=None):
+    """General-purpose routine to read from the database a row at a
+    time: rather than building a list of every row up front, rows are
+    fetched arraysize at a time and handed out as they're needed.
+
+    The connection is kept open until the last row has been read (or
+    the generator is closed), so make sure to read to the end or close
+    it, eg by using it in a for-loop.
+    """
+    if params is None:
+        params = []
+    if arraysize is None:
+        arraysize = ITER_ARRAYSIZE
+    request_db = getattr(_request, "db", None)
+    db = request_db if request_db is not None else POOL.acquire()
+    q = db.cursor()
+    q.arraysize = arraysize
+    try:
+        q.execute(sql_statement, params)
+        while True:
+            rows = q.fetchmany()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        q.close()
+        if request_db is None:
+            POOL.release(db)
 
 def execute(sql_statement, params=None):
     """General-purpose routine to write to the database
     """
     if params is None:
         params = []
-    db = sqlite3.connect(DATABASE_FILEPATH)
+    db = POOL.acquire()
     q = db.cursor()
     try:
         q.execute(sql_statement, params)
         db.commit()
     finally:
         q.close()
-        db.close()
+        POOL.release(db)
 
-def get_user(user_id):
-    """Return the user matching user_id
+def execute_many(sql_statement, rows, chunk_size=None):
+    """General-purpose routine to write many rows to the database: the
+    statement is run once for each row of parameters. Rows are read
+    from the iterable chunk_size at a time, so a generator can feed in
+    any number without them all being held in memory, but they're all
+    written in a single transaction: either every row is written or,
+    if anything goes wrong, none is.
+
+    Return the number of rows written
+    """
+    if chunk_size is None:
+        chunk_size = BULK_CHUNK_SIZE
+    rows = iter(rows)
+    n_rows = 0
+    db = POOL.acquire()
+    q = db.cursor()
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            q.executemany(sql_statement, chunk)
+            n_rows += len(chunk)
+        db.commit()
+    finally:
+        q.close()
+        #
+        # If we didn't get as far as committing, releasing the connection
+        # rolls back everything written so far.
+        #
+        POOL.release(db)
+    return n_rows
+
+def insert_many(table, columns, rows, chunk_size=None):
+    """Insert many rows into a table, reading them a chunk at a time and
+    writing them all in one transaction, as execute_many does -- but
+    with one INSERT for each chunk rather than one for each row. Each
+    chunk is put into a temporary table first and copied from there.
+    The temporary table is made afresh, with just the given columns,
+    each time: the connection goes back to the pool afterwards, and the
+    next caller may be inserting different columns.
+
+    That matters for bookings. sqlite opens a savepoint for each
+    statement which fires its triggers, and the full-text index writes
+    out everything it's holding at every savepoint. A statement per row
+    would make it write (and then keep merging) a tiny piece of index
+    for every booking.
+
+    Return the number of rows written
+    """
+    if chunk_size is None:
+        chunk_size = BULK_CHUNK_SIZE
+    columns = ", ".join(columns)
+    staged = "temp.staged_" + table
+    rows = iter(rows)
+    n_rows = 0
+    db = POOL.acquire()
+    q = db.cursor()
+    try:
+        q.execute("DROP TABLE IF EXISTS " + staged)
+        q.execute("CREATE TEMP TABLE staged_%s(%s)" % (table, columns))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            q.executemany(
+                "INSERT INTO %s(%s) VALUES(%s)" % (staged, columns, ", ".join("?" for row in chunk[0])),
+                chunk
+            )
+            q.execute("INSERT INTO %s(%s) SELECT %s FROM %s ORDER BY rowid" % (table, columns, columns, staged))
+            q.execute("DELETE FROM " + staged)
+            n_rows += len(chunk)
+        db.commit()
+        q.execute("DROP TABLE " + staged)
+    finally:
+        q.close()
+        POOL.release(db)
+    return n_rows
+
+#
+# Users and rooms are read on almost every page but hardly ever change,
+# so the most recently used of them are kept in memory. Changes made
+# by other processes are looked for at most every CACHE_CHECK_AFTER
+# seconds.
+#
+CACHE_SIZE = 1000
+CACHE_CHECK_AFTER = 1
+
+class RowCache(object):
+    """A bounded, least-recently-used cache of rows (or lists of rows)
+    read from the database, keyed by whatever the caller likes.
+
+    Anything written through this module clears the cache directly. To
+    notice writes made by other processes too -- another server, or an
+    import from the command line -- the cache keeps a connection of its
+    own and, every so often when it's used, reads table_versions, which
+    triggers bump whenever users or rooms change. (sqlite's own
+    data_version would change with every booking too, and with writes
+    made by this process, which have already cleared the cache.)
+    """
+
+    def __init__(self, size=CACHE_SIZE, check_after=CACHE_CHECK_AFTER):
+        self.size = size
+        self.check_after = check_after
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._rows = collections.OrderedDict()
+        self._watcher = None
+        self._generation = None
+        self._table_versions = None
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check(self):
+        """Clear the cache if users or rooms have changed since we last
+        looked. Called with the lock held.
+        """
+        now = time.time()
+        if self._generation == POOL.generation and now - self._checked_at < self.check_after:
+            return
+        self._checked_at = now
+        if self._watcher is None or self._generation != POOL.generation:
+            if self._watcher is not None:
+                POOL.discard(self._watcher)
+            self._generation = POOL.generation
+            self._watcher = connect()
+            self._table_versions = None
+        try:
+            table_versions = tuple(
+                tuple(row) for row in
+                self._watcher.execute("SELECT name, version FROM table_versions ORDER BY name")
+            )
+        except sqlite3.Error:
+            POOL.discard(self._watcher)
+            self._watcher = None
+            table_versions = None
+        if table_versions is None or table_versions != self._table_versions:
+            self._clear()
+        self._table_versions = table_versions
+
+    def _clear(self):
+        if self._rows:
+            self.invalidations += 1
+        self._rows.clear()
+        self._version += 1
+
+    def get(self, key, function, *args):
+        """Return the cached value for key, or call function(*args) to
+        read it and keep the result
+        """
+        with self._lock:
+            self._check()
+            if key in self._rows:
+                self._rows.move_to_end(key)
+                self.hits += 1
+                return self._rows[key]
+            self.misses += 1
+            version = self._version
+
+        #
+        # Read outside any request's snapshot: that may be older than the
+        # table_versions _check has just seen, and what's kept here
+        # outlives the request.
+        #
+        with outside_request():
+            value = function(*args)
+
+        with self._lock:
+            #
+            # Don't keep what we read if the cache was cleared while we
+            # were reading it: it may already be out of date.
+            #
+            if version == self._version:
+                self._rows[key] = value
+                if len(self._rows) > self.size:
+                    self._rows.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        """Forget everything, eg because a user or room has been added
+        """
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        """Return a dictionary of hits, misses and the hit rate
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                size=len(self._rows),
+                invalidations=self.invalidations,
+                hit_rate=float(self.hits) / total if total else 0.0
+            )
+
+CACHE = RowCache()
+
+def read_user(user_id):
+    """Read the user matching user_id from the database
     """
     for user in select("SELECT * FROM users WHERE id = ?", [user_id]):
         return user
 
-def get_room(room_id):
-    """Return the room matching room_id
+def read_room(room_id):
+    """Read the room matching room_id from the database
     """
     for room in select("SELECT * FROM rooms WHERE id = ?", [room_id]):
         return room
 
+def get_user(user_id):
+    """Return the user matching user_id
+    """
+    return CACHE.get(("user", user_id), read_user, user_id)
+
+def get_room(room_id):
+    """Return the room matching room_id
+    """
+    return CACHE.get(("room", room_id), read_room, room_id)
+
 def get_users():
     """Get all the users from the database
     """
-    return select("SELECT * FROM users")
+    return list(CACHE.get(("users",), lambda: tuple(select("SELECT * FROM users"))))
 
 def get_rooms():
     """Get all the rooms from the database
     """
-    return select("SELECT * FROM rooms")
+    return list(CACHE.get(("rooms",), lambda: tuple(select("SELECT * FROM rooms"))))
+
+class PrefixIndex(object):
+    """An in-memory index for looking rows up by the start of any word
+    in some of their text columns, as someone types.
+
+    Every word of every indexed column gives a key -- the lower-cased
+    text from that word to the end -- and the keys are kept in one
+    sorted list. All the keys starting with what's been typed then sit
+    next to each other in the list, and bisect finds the first of them
+    without looking at the rest.
+    """
+
+    def __init__(self, rows, columns):
+        self.rows = dict((row['id'], row) for row in rows)
+        keys = []
+        for row in rows:
+            for column in columns:
+                words = (row[column] or "").lower().split()
+                for n in range(len(words)):
+                    keys.append((" ".join(words[n:]), row['id']))
+        keys.sort()
+        self.keys = [key for key, id in keys]
+        self.ids = [id for key, id in keys]
+
+    def search(self, text, limit=None, offset=0):
+        """Return up to limit rows (all of them if limit is None) with a
+        word starting with text, skipping the first offset of them. A
+        row which matches more than once comes back only once.
+        """
+        text = " ".join(text.lower().split())
+        if not text:
+            return []
+        found = []
+        seen = set()
+        n = bisect.bisect_left(self.keys, text)
+        while n < len(self.keys) and self.keys[n].startswith(text):
+            id = self.ids[n]
+            n += 1
+            if id in seen:
+                continue
+            seen.add(id)
+            if len(seen) > offset:
+                found.append(self.rows[id])
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+def user_index():
+    """Return the PrefixIndex of users by name and email address, kept
+    in CACHE until the users change
+    """
+    return CACHE.get(("index", "users"), lambda: PrefixIndex(get_users(), ["name", "email_address"]))
+
+def room_index():
+    """Return the PrefixIndex of rooms by name, kept in CACHE until the
+    rooms change
+    """
+    return CACHE.get(("index", "rooms"), lambda: PrefixIndex(get_rooms(), ["name"]))
+
+#
+# Bookings are read from bookings_read, a copy of v_bookings kept as a
+# table by triggers, so that reading them doesn't mean joining to users
+# and rooms each time. Set USE_READ_MODEL to False to go back to the
+# view.
+#
+USE_READ_MODEL = True
+
+def bookings_source():
+    """Return the name of the table, or view, to read bookings from
+    """
+    return "bookings_read" if USE_READ_MODEL else "v_bookings"
+
+#
+# Listings of bookings are shown BOOKINGS_PAGE_SIZE at a time, in order
+# of (booked_on, booked_from, id).
+#
+BOOKINGS_PAGE_SIZE = 100
+
+def seek_bookings(condition=None, params=None, limit=None, after=None, before=None):
+    """Read bookings from bookings_source() in order of (booked_on,
+    booked_from, id) -- that is, by date, then time, with any booking
+    which has no start time first -- optionally only those matching an
+    SQL condition.
+
+    Pages of them are found by "seeking" rather than skipping: after or
+    before is the (booked_on, booked_from, id) of a booking, and only
+    the bookings which come after or before it are read, up to limit of
+    them. The query goes straight to that point in an index on the
+    same columns, so the hundredth page costs no more than the first,
+    where LIMIT ... OFFSET would have to read and throw away every
+    booking on the pages in between.
+
+    The bookings are always returned in ascending order; for before,
+    they're the limit bookings immediately before it.
+    """
+    conditions = [condition] if condition else []
+    params = list(params or [])
+    if before is not None:
+        key, comparison, direction = before, "<", "DESC"
+    else:
+        key, comparison, direction = after, ">", "ASC"
+
+    if key is not None:
+        booked_on, booked_from, id = key
+        #
+        # sqlite puts NULL before any other value, so a booking with no
+        # start time comes before any with one on the same day -- and
+        # "booked_from > NULL" is never true, so that has to be spelt
+        # out. The booked_on >= / <= on its own lets sqlite seek to the
+        # right day in the index; the rest sorts out that day.
+        #
+        if booked_from is None:
+            if comparison == ">":
+                same_day = "(booked_from IS NOT NULL OR id > ?)"
+            else:
+                same_day = "(booked_from IS NULL AND id < ?)"
+            same_day_params = [id]
+        else:
+            if comparison == ">":
+                same_day = "(booked_from > ? OR (booked_from = ? AND id > ?))"
+            else:
+                same_day = "(booked_from < ? OR booked_from IS NULL OR (booked_from = ? AND id < ?))"
+            same_day_params = [booked_from, booked_from, id]
+        conditions.append(
+            "booked_on %(c)s= ? AND (booked_on %(c)s ? OR (booked_on = ? AND %(same_day)s))" % {
+                "c" : comparison, "same_day" : same_day
+            }
+        )
+        params.extend([booked_on, booked_on, booked_on] + same_day_params)
+
+    sql = "SELECT * FROM " + bookings_source()
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY booked_on %(d)s, booked_from %(d)s, id %(d)s" % {"d" : direction}
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    bookings = select(sql, params)
+    if before is not None:
+        bookings.reverse()
+    return bookings
+
+def booking_key(booking):
+    """Return the (booked_on, booked_from, id) of a booking, by which
+    listings are ordered and paged
+    """
+    return booking['booked_on'], booking['booked_from'], booking['id']
+
+def get_bookings(limit=None, after=None, before=None):
+    """Get all the bookings ever made, in date and time order, or a page
+    of them (see seek_bookings)
+    """
+    return seek_bookings(None, None, limit, after, before)
 
-def get_bookings():
-    """Get all the bookings ever made
+def get_bookings_for_user(user_id, limit=None, after=None, before=None):
+    """Get all the bookings made by a user, in date and time order, or a
+    page of them (see seek_bookings)
     """
-    return select("SELECT * FROM v_bookings")
+    return seek_bookings("user_id = ?", [user_id], limit, after, before)
 
-def get_bookings_for_user(user_id):
-    """Get all the bookings made by a user
+def get_bookings_for_room(room_id, limit=None, after=None, before=None):
+    """Get all the bookings made against a room, in date and time order,
+    or a page of them (see seek_bookings)
     """
-    return select("SELECT * FROM v_bookings WHERE user_id = ?", [user_id])
+    return seek_bookings("room_id = ?", [room_id], limit, after, before)
 
-def get_bookings_for_room(room_id):
-    """Get all the bookings made against a room
+def get_bookings_between(start=None, end=None, room_id=None, user_id=None, limit=None, after=None, before=None):
+    """Get the bookings made from the date start to the date end (both
+    included), in date and time order, or a page of them (see
+    seek_bookings). Leave start or end as None to go back to the
+    beginning or on for ever. Give room_id or user_id for just that
+    room's or that user's bookings.
+
+    Each of the indexes the listings are paged through starts with
+    booked_on (after the room or user), so this reads only the bookings
+    in the range, not the whole history.
+    """
+    conditions = []
+    params = []
+    if room_id is not None:
+        conditions.append("room_id = ?")
+        params.append(room_id)
+    if user_id is not None:
+        #
+        # Given both, go through the room's index: a room can't be
+        # booked twice at once, so it has only so many bookings in any
+        # range of dates, where a user could have any number. The + stops
+        # sqlite from choosing the user's index instead.
+        #
+        conditions.append("+user_id = ?" if room_id is not None else "user_id = ?")
+        params.append(user_id)
+    if start is not None:
+        conditions.append("booked_on >= ?")
+        params.append(str(start))
+    if end is not None:
+        conditions.append("booked_on <= ?")
+        params.append(str(end))
+    return seek_bookings(" AND ".join(conditions), params, limit, after, before)
+
+#
+# The same listings as get_bookings and friends, but read a row at a
+# time rather than all at once (see iter_select), for going through
+# every booking without holding them all in memory.
+#
+BOOKINGS_ORDER = " ORDER BY booked_on, booked_from, id"
+
+def iter_bookings():
+    """Get all the bookings ever made, in date and time order, one at
+    a time
+    """
+    return iter_select("SELECT * FROM " + bookings_source() + BOOKINGS_ORDER)
+
+def iter_bookings_for_user(user_id):
+    """Get all the bookings made by a user, in date and time order, one
+    at a time
     """
-    return select("SELECT * FROM v_bookings WHERE room_id = ?", [room_id])
+    return iter_select("SELECT * FROM %s WHERE user_id = ?" % bookings_source() + BOOKINGS_ORDER, [user_id])
+
+def iter_bookings_for_room(room_id):
+    """Get all the bookings made against a room, in date and time order,
+    one at a time
+    """
+    return iter_select("SELECT * FROM %s WHERE room_id = ?" % bookings_source() + BOOKINGS_ORDER, [room_id])
 
 def add_user_to_database(name, email_address):
     """Add a user to the database
@@ -166,6 +1414,7 @@ def add_user_to_database(name, email_address):
         "INSERT INTO users(name, email_address) VALUES (?, ?)",
         [name, email_address]
     )
+    CACHE.invalidate()
 
 def add_room_to_database(name, location):
     """Add a user to the database
@@ -174,23 +1423,1010 @@ def add_room_to_database(name, location):
         "INSERT INTO rooms(name, location) VALUES (?, ?)",
         [name, location]
     )
+    CACHE.invalidate()
 
-def add_booking_to_database(user_id, room_id, booked_on, booked_from=None, booked_to=None):
-    """Add a booking to the database
+class BookingConflict(Exception):
+    """A booking would overlap one already made for the same room. If
+    we know which one, it's the booking attribute (a row from v_bookings).
     """
-    execute(
+    def __init__(self, booking=None):
+        self.booking = booking
+        if booking is None:
+            message = "That booking overlaps one already made for the same room"
+        else:
+            message = "%s is already booked by %s on %s from %s to %s" % (
+                booking['room_name'],
+                booking['user_name'],
+                booking['booked_on'],
+                booking['booked_from'] or "the start of the day",
+                booking['booked_to'] or "the end of the day"
+            )
+        Exception.__init__(self, message)
+
+def is_booking_conflict(exc):
+    """Was this error raised by the database refusing an overlapping booking?
+    """
+    return isinstance(exc, sqlite3.IntegrityError) and "booking conflict" in str(exc)
+
+class BadBookingTimes(Exception):
+    """A booking's date or times can't be read, or it would end before
+    it starts, or at the same time.
+    """
+    def __init__(self, message="A booking must end after it starts"):
+        Exception.__init__(self, message)
+
+def is_bad_booking_times(exc):
+    """Was this error raised by the database refusing an empty or
+    backwards booking?
+    """
+    return isinstance(exc, sqlite3.IntegrityError) and "booking times backwards" in str(exc)
+
+#
+# Bookings are compared with each other by their text, in the database
+# (see create.sql) as well as here, so dates and times are always
+# stored the same way: dates as YYYY-MM-DD and times as HH:MM, from
+# 00:00 to 24:00. Dates and times given in any other way which can be
+# read unambiguously, eg 2030-1-2 or 9:30, are turned into those.
+#
+DATE_PATTERN = re.compile(r"^\s*(\d{4})-(\d{1,2})-(\d{1,2})\s*$")
+TIME_PATTERN = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*$")
+
+def normalise_date(booked_on):
+    """Return the date (a datetime.date or a string like "2030-1-2")
+    as YYYY-MM-DD, or raise BadBookingTimes if it isn't a date
+    """
+    if isinstance(booked_on, datetime.date):
+        return booked_on.strftime("%Y-%m-%d")
+    match = DATE_PATTERN.match(booked_on or "")
+    try:
+        if not match:
+            raise ValueError
+        return datetime.date(*(int(part) for part in match.groups())).isoformat()
+    except ValueError:
+        raise BadBookingTimes("%r isn't a date like 2030-01-02" % (booked_on or "",))
+
+def normalise_time(time_of_day):
+    """Return the time (a string like "9:30") as HH:MM, or None if
+    there's no time, or raise BadBookingTimes if it isn't a time
+    """
+    if time_of_day is None or not str(time_of_day).strip():
+        return None
+    try:
+        return minutes_to_time(time_to_minutes(str(time_of_day)))
+    except ValueError as exc:
+        raise BadBookingTimes(str(exc))
+
+def normalise_booking(booked_on, booked_from=None, booked_to=None):
+    """Return (booked_on, booked_from, booked_to) written the way
+    they're stored, or raise BadBookingTimes if they can't be read or
+    the booking would end before it starts
+    """
+    booked_on = normalise_date(booked_on)
+    booked_from = normalise_time(booked_from)
+    booked_to = normalise_time(booked_to)
+    if (booked_from or "00:00") >= (booked_to or "24:00"):
+        raise BadBookingTimes()
+    return booked_on, booked_from, booked_to
+
+def find_conflicting_booking(room_id, booked_on, booked_from=None, booked_to=None):
+    """Return a booking of the room which overlaps the given day and
+    times, or None if the room is free then. Missing times are treated
+    the same way as they are for bookings: no start time means from the
+    start of the day and no end time means to the end of it.
+    """
+    for booking in select(
         """
-        INSERT INTO bookings(user_id, room_id, booked_on, booked_from, booked_to)
-        VALUES(?, ?, ?, ?, ?)
+        SELECT * FROM v_bookings AS boo
+        WHERE boo.room_id = ?
+        AND boo.booked_on = ?
+        AND COALESCE(NULLIF(boo.booked_from, ''), '00:00') < COALESCE(NULLIF(?, ''), '24:00')
+        AND COALESCE(NULLIF(?, ''), '00:00') < COALESCE(NULLIF(boo.booked_to, ''), '24:00')
         """,
-        [user_id, room_id, booked_on, booked_from, booked_to]
-    )
+        [room_id, booked_on, booked_to, booked_from]
+    ):
+        return booking
 
-def page(title, content):
-    """Return a complete HTML page with the title as the <title> and <h1>
-    tags, and the content within the body, after the <h1>
+def find_available_rooms(booked_on, booked_from=None, booked_to=None):
+    """Return all the rooms which are free on the given day between the
+    given times (with the same meaning of missing times as for a booking).
+
+    This is one query over all the rooms. When the times fall on
+    quarter-hours, the rooms which are busy are found by checking that
+    day's bitmaps (see room_day_slots) against the times. Otherwise the
+    bookings which get in the way are all found at once from the index
+    on bookings(booked_on, ...). Either way, the time taken depends on
+    the number of rooms and that day's bookings, not on the number of
+    bookings altogether.
+    """
+    if is_on_slot_boundaries(booked_from, booked_to):
+        mask = slot_mask(booked_from, booked_to)
+        return select(
+            """
+            SELECT * FROM rooms
+            WHERE id NOT IN (
+                SELECT room_id FROM room_day_slots
+                WHERE booked_on = ?
+                AND (early_slots & ? OR late_slots & ?)
+            )
+            ORDER BY name
+            """,
+            [booked_on, mask & ((1 << 48) - 1), mask >> 48]
+        )
+
+    return select(
+        """
+        SELECT * FROM rooms
+        WHERE id NOT IN (
+            SELECT boo.room_id FROM bookings AS boo
+            WHERE boo.booked_on = ?
+            AND COALESCE(NULLIF(boo.booked_from, ''), '00:00') < COALESCE(NULLIF(?, ''), '24:00')
+            AND COALESCE(NULLIF(?, ''), '00:00') < COALESCE(NULLIF(boo.booked_to, ''), '24:00')
+        )
+        ORDER BY name
+        """,
+        [booked_on, booked_to, booked_from]
+    )
+
+#
+# Each day is divided into quarter-hour slots for the bitmaps of which
+# rooms are booked when (see room_day_slots in create.sql). Slot 0 is
+# midnight to 00:15, slot 95 is 23:45 to midnight, and slot 96 is the
+# end of the day.
+#
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 96
+
+def time_to_minutes(time_of_day):
+    """Turn a time like "09:30" (or "9:30") into the number of minutes
+    since midnight (570), or None if there's no time. Raise ValueError
+    if it isn't a time from 00:00 to 24:00. The database refuses any
+    other times for bookings (see create.sql), so v_booking_slots, which
+    reads them the same way, never sees one.
+    """
+    if not time_of_day:
+        return None
+    match = TIME_PATTERN.match(time_of_day)
+    if match:
+        hours, minutes = (int(part) for part in match.groups())
+        if minutes < 60 and (hours < 24 or (hours, minutes) == (24, 0)):
+            return hours * 60 + minutes
+    raise ValueError("%r isn't a time like 09:30" % (time_of_day,))
+
+def time_to_slots(booked_from=None, booked_to=None):
+    """Return the first slot touched by the times and the slot after the
+    last one, rounding outwards to whole quarter-hours. No start time is
+    the start of the day and no end time is the end of it.
+    """
+    start = time_to_minutes(booked_from)
+    end = time_to_minutes(booked_to)
+    first_slot = 0 if start is None else min(max(start // SLOT_MINUTES, 0), SLOTS_PER_DAY)
+    end_slot = SLOTS_PER_DAY if end is None else min(max((end + SLOT_MINUTES - 1) // SLOT_MINUTES, 0), SLOTS_PER_DAY)
+    return first_slot, end_slot
+
+def minutes_to_time(minutes):
+    """Turn a number of minutes since midnight into a time like "09:30"
+    """
+    return "%02d:%02d" % divmod(minutes, 60)
+
+def slots_to_time(slot):
+    """Return the time at which a slot starts, eg "09:30"
+    """
+    return minutes_to_time(slot * SLOT_MINUTES)
+
+def slot_mask(booked_from=None, booked_to=None):
+    """Return the bitmap of the slots touched by the times
+    """
+    first_slot, end_slot = time_to_slots(booked_from, booked_to)
+    if end_slot <= first_slot:
+        return 0
+    return (1 << end_slot) - (1 << first_slot)
+
+def is_on_slot_boundaries(booked_from=None, booked_to=None):
+    """Do the times fall exactly on quarter-hours? If they do, checking
+    them against the bitmaps gives exactly the same answer as checking
+    them against the bookings themselves.
+    """
+    for time_of_day in (booked_from, booked_to):
+        minutes = time_to_minutes(time_of_day)
+        if minutes is not None and minutes % SLOT_MINUTES:
+            return False
+    return True
+
+def fill_room_day_slots(db):
+    """Work out all the bitmaps again from the bookings, using the
+    given connection (and its transaction, if it's in one)
+    """
+    db.execute("DELETE FROM room_day_slots")
+    rows = db.execute("""
+    SELECT booked_on, room_id, early_mask, late_mask
+    FROM v_booking_slots
+    ORDER BY booked_on, room_id
+    """)
+    def merged():
+        for (booked_on, room_id), masks in itertools.groupby(rows, lambda row: (row[0], row[1])):
+            early_slots = late_slots = 0
+            for row in masks:
+                early_slots |= row[2]
+                late_slots |= row[3]
+            yield booked_on, room_id, early_slots, late_slots
+    db.executemany(
+        "INSERT INTO room_day_slots(booked_on, room_id, early_slots, late_slots) VALUES(?, ?, ?, ?)",
+        merged()
+    )
+
+#
+# A full-text index with one document for each booking, made up of the
+# name and email address of the user and the name and location of the
+# room, so that a search like "smith second floor" finds bookings by
+# anyone called Smith in rooms on the second floor. Each document's
+# rowid is the booking's id. The triggers keep it in step with the
+# bookings, and with any change to a user or room. The index also keeps
+# the first two and three letters of each word, so that a search for a
+# word which has only just been started isn't slow.
+#
+SEARCH_INDEX_SQL = """
+CREATE VIRTUAL TABLE
+    bookings_fts
+USING fts5
+(
+    user_name, email_address, room_name, location,
+    prefix = '2 3'
+)
+;
+
+INSERT INTO bookings_fts(rowid, user_name, email_address, room_name, location)
+SELECT boo.id, usr.name, usr.email_address, roo.name, roo.location
+FROM bookings AS boo
+JOIN users AS usr ON usr.id = boo.user_id
+JOIN rooms AS roo ON roo.id = boo.room_id
+;
+
+CREATE TRIGGER
+    tr_bookings_fts_insert
+AFTER INSERT ON bookings
+BEGIN
+    INSERT INTO bookings_fts(rowid, user_name, email_address, room_name, location)
+    SELECT NEW.id, usr.name, usr.email_address, roo.name, roo.location
+    FROM users AS usr, rooms AS roo
+    WHERE usr.id = NEW.user_id AND roo.id = NEW.room_id;
+END
+;
+
+CREATE TRIGGER
+    tr_bookings_fts_delete
+AFTER DELETE ON bookings
+BEGIN
+    DELETE FROM bookings_fts WHERE rowid = OLD.id;
+END
+;
+
+CREATE TRIGGER
+    tr_bookings_fts_update
+AFTER UPDATE OF user_id, room_id ON bookings
+BEGIN
+    DELETE FROM bookings_fts WHERE rowid = OLD.id;
+    INSERT INTO bookings_fts(rowid, user_name, email_address, room_name, location)
+    SELECT NEW.id, usr.name, usr.email_address, roo.name, roo.location
+    FROM users AS usr, rooms AS roo
+    WHERE usr.id = NEW.user_id AND roo.id = NEW.room_id;
+END
+;
+
+CREATE TRIGGER
+    tr_users_fts_update
+AFTER UPDATE OF name, email_address ON users
+BEGIN
+    UPDATE bookings_fts SET user_name = NEW.name, email_address = NEW.email_address
+    WHERE rowid IN (SELECT id FROM bookings WHERE user_id = NEW.id);
+END
+;
+
+CREATE TRIGGER
+    tr_rooms_fts_update
+AFTER UPDATE OF name, location ON rooms
+BEGIN
+    UPDATE bookings_fts SET room_name = NEW.name, location = NEW.location
+    WHERE rowid IN (SELECT id FROM bookings WHERE room_id = NEW.id);
+END
+;
+"""
+
+#
+# Like bookings_read, the index only has the bookings whose user and room
+# both exist. A booking can arrive before them -- eg when bookings are
+# imported before users -- so when a user or room is added, its bookings
+# are indexed if they aren't already, and when one is removed, its
+# bookings go from the index.
+#
+SEARCH_INDEX_ARRIVALS_SQL = """
+CREATE TRIGGER IF NOT EXISTS
+    tr_users_fts_insert
+AFTER INSERT ON users
+BEGIN
+    INSERT INTO bookings_fts(rowid, user_name, email_address, room_name, location)
+    SELECT boo.id, NEW.name, NEW.email_address, roo.name, roo.location
+    FROM bookings AS boo
+    JOIN rooms AS roo ON roo.id = boo.room_id
+    WHERE boo.user_id = NEW.id
+    AND NOT EXISTS (SELECT 1 FROM bookings_fts WHERE rowid = boo.id);
+END
+;
+
+CREATE TRIGGER IF NOT EXISTS
+    tr_rooms_fts_insert
+AFTER INSERT ON rooms
+BEGIN
+    INSERT INTO bookings_fts(rowid, user_name, email_address, room_name, location)
+    SELECT boo.id, usr.name, usr.email_address, NEW.name, NEW.location
+    FROM bookings AS boo
+    JOIN users AS usr ON usr.id = boo.user_id
+    WHERE boo.room_id = NEW.id
+    AND NOT EXISTS (SELECT 1 FROM bookings_fts WHERE rowid = boo.id);
+END
+;
+
+CREATE TRIGGER IF NOT EXISTS
+    tr_users_fts_delete
+AFTER DELETE ON users
+BEGIN
+    DELETE FROM bookings_fts WHERE rowid IN (SELECT id FROM bookings WHERE user_id = OLD.id);
+END
+;
+
+CREATE TRIGGER IF NOT EXISTS
+    tr_rooms_fts_delete
+AFTER DELETE ON rooms
+BEGIN
+    DELETE FROM bookings_fts WHERE rowid IN (SELECT id FROM bookings WHERE room_id = OLD.id);
+END
+;
+"""
+
+def has_fts5(db):
+    """Can this build of sqlite make FTS5 tables?
+    """
+    try:
+        db.execute("CREATE VIRTUAL TABLE temp.fts5_check USING fts5(text)")
+    except sqlite3.OperationalError:
+        return False
+    db.execute("DROP TABLE temp.fts5_check")
+    return True
+
+def create_search_index(db):
+    """Make the full-text index of bookings and fill it, using the given
+    connection (and its transaction, if it's in one). If sqlite can't do
+    that, leave it out: search() will look through the tables instead.
+    """
+    if not has_fts5(db):
+        return
+    for statement in split_statements(SEARCH_INDEX_SQL + SEARCH_INDEX_ARRIVALS_SQL):
+        db.execute(statement)
+
+def add_search_index_arrivals(db):
+    """Add the triggers which index bookings when their user or room is
+    added, if the database has a full-text index at all
+    """
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bookings_fts'").fetchall():
+        return
+    for statement in split_statements(SEARCH_INDEX_ARRIVALS_SQL):
+        db.execute(statement)
+
+#
+# The number of bookings on each page of search results. Ranking the
+# matches means scoring every one of them, so when more than
+# SEARCH_RANK_LIMIT bookings match (eg a search for "room") they come
+# newest first instead: with that many, the ranking says little anyway.
+#
+SEARCH_PAGE_SIZE = 50
+SEARCH_RANK_LIMIT = 10000
+
+def has_search_index():
+    """Does the database have the full-text index of bookings?
+    """
+    return bool(select("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bookings_fts'"))
+
+def search(text, limit=None, offset=0):
+    """Find the bookings whose user's name or email address, or whose
+    room's name or location, contain every word of text. Return up to
+    limit bookings (SEARCH_PAGE_SIZE by default), skipping
+    the first offset.
+
+    With the full-text index, the last word also matches longer words
+    it's the start of (as though it's still being typed) and the best
+    matches come first. Without it, each word has to appear somewhere
+    in one of the columns, and the bookings come in date order.
+    """
+    if limit is None:
+        limit = SEARCH_PAGE_SIZE
+    words = text.split()
+    if not words:
+        return []
+
+    if has_search_index():
+        #
+        # Quote each word so nothing in it is taken as FTS5 syntax.
+        # Words next to each other must all match.
+        #
+        match = " ".join('"%s"' % word.replace('"', '""') for word in words) + "*"
+        n_matches = select(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM bookings_fts WHERE bookings_fts MATCH ? LIMIT ?)",
+            [match, SEARCH_RANK_LIMIT + 1]
+        )[0][0]
+        #
+        # Even asking for the rank of a single match scores the words
+        # against the whole index, so only mention it if it's used.
+        #
+        if n_matches <= SEARCH_RANK_LIMIT:
+            columns, order_by = "rowid, rank", "rank"
+        else:
+            columns, order_by = "rowid", "rowid DESC"
+        #
+        # Order and cut down to the page in the full-text index alone,
+        # where sqlite can do it without looking at the bookings, then
+        # join just that page to the bookings.
+        #
+        return select(
+            """
+            SELECT boo.* FROM (
+                SELECT %(columns)s FROM bookings_fts
+                WHERE bookings_fts MATCH ?
+                ORDER BY %(order_by)s
+                LIMIT ? OFFSET ?
+            ) AS hit
+            JOIN %(bookings)s AS boo ON boo.id = hit.rowid
+            ORDER BY hit.%(order_by)s
+            """ % {"columns" : columns, "order_by" : order_by, "bookings" : bookings_source()},
+            [match, limit, offset]
+        )
+
+    conditions = []
+    params = []
+    for word in words:
+        pattern = "%" + word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append(
+            "(" + " OR ".join(
+                "%s LIKE ? ESCAPE '\\'" % column
+                for column in ("usr.name", "usr.email_address", "roo.name", "roo.location")
+            ) + ")"
+        )
+        params.extend([pattern] * 4)
+    return select(
+        """
+        SELECT boo.* FROM %s AS boo
+        JOIN users AS usr ON usr.id = boo.user_id
+        JOIN rooms AS roo ON roo.id = boo.room_id
+        WHERE %s
+        ORDER BY boo.booked_on, boo.booked_from, boo.id
+        LIMIT ? OFFSET ?
+        """ % (bookings_source(), " AND ".join(conditions)),
+        params + [limit, offset]
+    )
+
+def rebuild_room_day_slots():
+    """Work out all the bitmaps again from the bookings, eg if they've
+    been changed by something which bypassed the database triggers
+    """
+    db = POOL.acquire()
+    try:
+        fill_room_day_slots(db)
+        db.commit()
+    finally:
+        POOL.release(db)
+
+def get_day_slots(booked_on):
+    """Return a dictionary mapping the id of every room which has
+    bookings on the day to the bitmap of its booked slots. A room which
+    isn't in the dictionary is free all day.
+    """
+    return dict(
+        (row['room_id'], row['early_slots'] | (row['late_slots'] << 48))
+        for row in select(
+            "SELECT room_id, early_slots, late_slots FROM room_day_slots WHERE booked_on = ?",
+            [booked_on]
+        )
+    )
+
+def get_room_day_slots(room_id, booked_on):
+    """Return the bitmap of the slots booked for a room on a day
+    """
+    for row in select(
+        "SELECT early_slots, late_slots FROM room_day_slots WHERE booked_on = ? AND room_id = ?",
+        [booked_on, room_id]
+    ):
+        return row['early_slots'] | (row['late_slots'] << 48)
+    return 0
+
+def is_room_free(room_id, booked_on, booked_from=None, booked_to=None):
+    """Is the room free for the whole of the given times? The bitmap
+    answers that by itself unless the times are part-way through a
+    quarter-hour which is partly booked, in which case the bookings
+    themselves are checked.
     """
-    return """
+    if not get_room_day_slots(room_id, booked_on) & slot_mask(booked_from, booked_to):
+        return True
+    if is_on_slot_boundaries(booked_from, booked_to):
+        return False
+    return find_conflicting_booking(room_id, booked_on, booked_from, booked_to) is None
+
+#
+# When looking for free time in a room, only suggest times between
+# these, and look at most this many days ahead.
+#
+OPENING_TIME = "08:00"
+CLOSING_TIME = "18:00"
+FREE_TIME_SEARCH_DAYS = 365
+
+def iter_free_times(room_id, after=None, days=None):
+    """Generate the periods when a room is free, in order, starting from
+    after (a datetime; now by default) and going on for the given number
+    of days. Each is (booked_on, free_from, free_to), where the times
+    are minutes since midnight and within opening hours.
+
+    The room's bookings are read in date and time order straight from
+    the index on bookings(room_id, booked_on, booked_from), and only as
+    far as the search gets: finding a gap tomorrow doesn't mean reading
+    the rest of the year's bookings.
+    """
+    if after is None:
+        after = datetime.datetime.now()
+    elif not isinstance(after, datetime.datetime):
+        after = datetime.datetime.combine(after, datetime.time())
+    if days is None:
+        days = FREE_TIME_SEARCH_DAYS
+    opening = time_to_minutes(OPENING_TIME)
+    closing = time_to_minutes(CLOSING_TIME)
+    first_day = after.date()
+    last_day = first_day + datetime.timedelta(days=days)
+
+    bookings = iter_select(
+        """
+        SELECT booked_on, booked_from, booked_to FROM bookings
+        WHERE room_id = ? AND booked_on >= ? AND booked_on < ?
+        ORDER BY booked_on, booked_from
+        """,
+        [room_id, str(first_day), str(last_day)]
+    )
+    try:
+        by_day = itertools.groupby(bookings, lambda booking: booking['booked_on'])
+        booked_on, bookings_that_day = next(by_day, (None, None))
+        day = first_day
+        while day < last_day:
+            free_from = opening
+            if day == first_day:
+                free_from = max(opening, after.hour * 60 + after.minute)
+            if booked_on == str(day):
+                for booking in bookings_that_day:
+                    start = time_to_minutes(booking['booked_from']) or 0
+                    end = time_to_minutes(booking['booked_to'])
+                    if end is None:
+                        end = 24 * 60
+                    if min(start, closing) > free_from:
+                        yield str(day), free_from, min(start, closing)
+                    free_from = max(free_from, end)
+                booked_on, bookings_that_day = next(by_day, (None, None))
+            if closing > free_from:
+                yield str(day), free_from, closing
+            day += datetime.timedelta(days=1)
+    finally:
+        bookings.close()
+
+def find_next_free_slot(room_id, duration, after=None, days=None):
+    """Find the first time after `after` (now by default) when the room
+    is free for `duration` minutes. Return (booked_on, booked_from,
+    booked_to), or None if there's no such time in the next `days` days.
+    """
+    free_slot = find_next_free_slot_in_rooms([room_id], duration, after, days)
+    if free_slot:
+        return free_slot[1:]
+    return None
+
+def find_next_free_slot_in_rooms(room_ids, duration, after=None, days=None):
+    """Find the first time after `after` (now by default) when any of
+    the rooms is free for `duration` minutes. Return (room_id, booked_on,
+    booked_from, booked_to), or None if there's no such time in the next
+    `days` days.
+
+    The rooms are searched together in one pass, by merging the free
+    times of all the rooms into one stream in time order. Each room's
+    bookings are only read up to the point the search reaches.
+    """
+    def tagged(room_id):
+        for booked_on, free_from, free_to in iter_free_times(room_id, after, days):
+            yield booked_on, free_from, free_to, room_id
+
+    #
+    # Read all the rooms through one connection and snapshot
+    #
+    with request_context():
+        streams = [tagged(room_id) for room_id in room_ids]
+        try:
+            for booked_on, free_from, free_to, room_id in heapq.merge(*streams):
+                if free_to - free_from >= duration:
+                    return room_id, booked_on, minutes_to_time(free_from), minutes_to_time(free_from + duration)
+        finally:
+            for stream in streams:
+                stream.close()
+    return None
+
+def add_booking_to_database(user_id, room_id, booked_on, booked_from=None, booked_to=None):
+    """Add a booking to the database. If the room is already booked at
+    any time during the booking, raise BookingConflict; if it would end
+    before it starts, or as it starts, raise BadBookingTimes.
+
+    The check is made by the database itself (see create.sql) as part
+    of adding the booking, so two people trying to book the same slot
+    at the same moment can't both succeed.
+    """
+    booked_on, booked_from, booked_to = normalise_booking(booked_on, booked_from, booked_to)
+    try:
+        execute(
+            """
+            INSERT INTO bookings(user_id, room_id, booked_on, booked_from, booked_to)
+            VALUES(?, ?, ?, ?, ?)
+            """,
+            [user_id, room_id, booked_on, booked_from, booked_to]
+        )
+    except sqlite3.IntegrityError as exc:
+        if is_bad_booking_times(exc):
+            raise BadBookingTimes()
+        if not is_booking_conflict(exc):
+            raise
+        raise BookingConflict(find_conflicting_booking(room_id, booked_on, booked_from, booked_to))
+
+def add_users_to_database(users, chunk_size=None):
+    """Add many users to the database in one go. Each user is a
+    sequence of (name, email_address).
+    """
+    try:
+        return execute_many(
+            "INSERT INTO users(name, email_address) VALUES (?, ?)",
+            users,
+            chunk_size
+        )
+    finally:
+        CACHE.invalidate()
+
+def add_rooms_to_database(rooms, chunk_size=None):
+    """Add many rooms to the database in one go. Each room is a
+    sequence of (name, location).
+    """
+    try:
+        return execute_many(
+            "INSERT INTO rooms(name, location) VALUES (?, ?)",
+            rooms,
+            chunk_size
+        )
+    finally:
+        CACHE.invalidate()
+
+def add_bookings_to_database(bookings, chunk_size=None):
+    """Add many bookings to the database in one go. Each booking is a
+    sequence of (user_id, room_id, booked_on, booked_from, booked_to),
+    where booked_from and booked_to can be left off, as they can for
+    add_booking_to_database.
+
+    If any of the bookings overlaps another, BookingConflict is raised
+    and none of them is added; likewise BadBookingTimes if any has a
+    date or time which can't be read or ends before it starts.
+    """
+    def normalised(booking):
+        user_id, room_id, booked_on, booked_from, booked_to = (tuple(booking) + (None, None))[:5]
+        return (user_id, room_id) + normalise_booking(booked_on, booked_from, booked_to)
+    try:
+        return insert_many(
+            "bookings",
+            ["user_id", "room_id", "booked_on", "booked_from", "booked_to"],
+            (normalised(booking) for booking in bookings),
+            chunk_size
+        )
+    except sqlite3.IntegrityError as exc:
+        if is_bad_booking_times(exc):
+            raise BadBookingTimes()
+        if not is_booking_conflict(exc):
+            raise
+        raise BookingConflict()
+
+def partition_day(room_ids, existing, wanted):
+    """Fit the wanted times into the rooms on one day, around the
+    bookings already there. `existing` is a list of (room_id, start,
+    end) and `wanted` a list of (start, end, preferred_room_ids), with
+    the times as minutes since midnight.
+
+    Return a list with the room given to each of the wanted times, or
+    None where no room was free.
+
+    This is the usual interval-partitioning sweep: take everything in
+    order of start time, keeping one heap of the rooms in use, by when
+    they come free, and another of the rooms which are free. The
+    existing bookings are part of the sweep, each one taking its own
+    room. A room which is free now may still have a booking later in
+    the day, so the free rooms are ordered by when their next existing
+    booking starts: if the room at the top can't fit the wanted time
+    in before then, none can. A preferred room is used ahead of the
+    heap if it's free for long enough. Each room has a counter which
+    goes up whenever it's taken, so entries left behind on the heaps
+    by an earlier state of the room are recognised and skipped.
+    """
+    whole_day = 24 * 60
+    booking_starts = dict((room_id, collections.deque()) for room_id in room_ids)
+    events = []
+    for room_id, start, end in sorted(existing, key=lambda booking: booking[1]):
+        if room_id in booking_starts:
+            booking_starts[room_id].append(start)
+            events.append((start, 0, end, room_id))
+    for n, (start, end, preferred) in enumerate(wanted):
+        events.append((start, 1, end, n))
+    events.sort()
+
+    def next_booking(room_id):
+        starts = booking_starts[room_id]
+        return starts[0] if starts else whole_day
+
+    free_at = dict((room_id, 0) for room_id in room_ids)
+    taken = dict((room_id, 0) for room_id in room_ids)
+    in_use = []
+    free = [(-next_booking(room_id), room_id, 0) for room_id in room_ids]
+    heapq.heapify(free)
+    rooms = [None] * len(wanted)
+
+    def take(room_id, end):
+        taken[room_id] += 1
+        free_at[room_id] = max(free_at[room_id], end)
+        heapq.heappush(in_use, (free_at[room_id], room_id, taken[room_id]))
+
+    for start, is_wanted, end, n_or_room_id in events:
+        while in_use and in_use[0][0] <= start:
+            _, room_id, count = heapq.heappop(in_use)
+            if count == taken[room_id]:
+                heapq.heappush(free, (-next_booking(room_id), room_id, count))
+
+        if not is_wanted:
+            room_id = n_or_room_id
+            booking_starts[room_id].popleft()
+            take(room_id, end)
+            continue
+
+        n = n_or_room_id
+        if end <= start:
+            continue
+        for room_id in wanted[n][2] or []:
+            if room_id in free_at and free_at[room_id] <= start and next_booking(room_id) >= end:
+                break
+        else:
+            room_id = None
+            while free:
+                next_start, room_id, count = free[0]
+                if count != taken[room_id]:
+                    heapq.heappop(free)
+                    room_id = None
+                    continue
+                if -next_start < end:
+                    room_id = None
+                break
+        if room_id is not None:
+            take(room_id, end)
+            rooms[n] = room_id
+
+    return rooms
+
+def schedule_bookings(requests, room_ids=None, commit=True):
+    """Find rooms for a batch of meetings. Each request is a sequence of
+    (user_id, booked_on, booked_from, booked_to, preferred_room_ids),
+    where the preferred rooms can be left off or None. The rooms to
+    choose from are all the rooms unless room_ids is given.
+
+    Each day's requests are fitted around that day's existing bookings
+    by partition_day, and then, if commit is true, all the new bookings
+    are added in one transaction by add_bookings_to_database. (If
+    someone else books one of the same rooms in the meantime, that
+    raises BookingConflict and nothing is added.)
+
+    Return (bookings, unplaced): the new bookings, as (user_id, room_id,
+    booked_on, booked_from, booked_to), and the requests which couldn't
+    be given a room, each in the order they were asked for.
+    """
+    requests = [(tuple(request) + (None, None, None))[:5] for request in requests]
+    by_day = {}
+    for n, request in enumerate(requests):
+        by_day.setdefault(str(request[1]), []).append(n)
+
+    def minutes(time_of_day, default):
+        minutes = time_to_minutes(time_of_day)
+        return default if minutes is None else minutes
+
+    rooms = [None] * len(requests)
+    with request_context():
+        if room_ids is None:
+            room_ids = [room['id'] for room in get_rooms()]
+        room_ids = list(room_ids)
+        for booked_on, ns in by_day.items():
+            existing = [
+                (
+                    booking['room_id'],
+                    minutes(booking['booked_from'], 0),
+                    minutes(booking['booked_to'], 24 * 60)
+                ) for booking in select(
+                    "SELECT room_id, booked_from, booked_to FROM bookings WHERE booked_on = ?",
+                    [booked_on]
+                )
+            ]
+            wanted = [
+                (
+                    minutes(requests[n][2], 0),
+                    minutes(requests[n][3], 24 * 60),
+                    requests[n][4]
+                ) for n in ns
+            ]
+            for n, room_id in zip(ns, partition_day(room_ids, existing, wanted)):
+                rooms[n] = room_id
+
+    bookings = []
+    unplaced = []
+    for (user_id, booked_on, booked_from, booked_to, preferred), room_id in zip(requests, rooms):
+        if room_id is None:
+            unplaced.append((user_id, booked_on, booked_from, booked_to, preferred))
+        else:
+            bookings.append((user_id, room_id, booked_on, booked_from, booked_to))
+    if commit and bookings:
+        add_bookings_to_database(bookings)
+    return bookings, unplaced
+
+#
+# The columns which can be imported from and exported to CSV for each
+# table. The first line of a CSV file names its columns; any of these
+# which are missing are left to their defaults (eg a new id is given).
+#
+CSV_COLUMNS = {
+    "users" : ["id", "name", "email_address"],
+    "rooms" : ["id", "name", "location"],
+    "bookings" : ["id", "user_id", "room_id", "booked_on", "booked_from", "booked_to"],
+}
+
+def open_csv(filepath, mode):
+    """Open a CSV file for reading or writing, where "-" means stdin
+    or stdout
+    """
+    if filepath == "-":
+        return contextlib.closing(sys.stdin if mode == "r" else sys.stdout)
+    return open(filepath, mode, newline="", encoding="utf-8")
+
+def report(action, n_rows, table, started_at):
+    """Say how many rows were handled and how quickly
+    """
+    seconds = max(time.time() - started_at, 0.001)
+    sys.stderr.write("%s %d %s in %.1fs (%d rows/s)\n" % (action, n_rows, table, seconds, n_rows / seconds))
+
+def normalise_csv_booking(header, row):
+    """Write the date and times of a booking read from CSV the way
+    they're stored (see normalise_booking)
+    """
+    values = dict(zip(header, row))
+    values['booked_on'], values['booked_from'], values['booked_to'] = normalise_booking(
+        values.get('booked_on'), values.get('booked_from'), values.get('booked_to')
+    )
+    return [values[column] for column in header]
+
+def import_csv(table, filepath, chunk_size=None):
+    """Read users, rooms or bookings from a CSV file into the database.
+
+    The file is read a chunk at a time and each chunk is written in
+    its own transaction, so a file of any size can be loaded without
+    holding it all in memory. (If something goes wrong part-way
+    through, the chunks already written stay written.) Empty fields
+    are stored as NULL, and the dates and times of bookings are
+    written the way they're stored (see normalise_booking).
+
+    Return the number of rows imported
+    """
+    if chunk_size is None:
+        chunk_size = BULK_CHUNK_SIZE
+    started_at = time.time()
+    n_rows = 0
+    with open_csv(filepath, "r") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        unknown = [column for column in header if column not in CSV_COLUMNS[table]]
+        if unknown:
+            raise ValueError("Unknown columns for %s: %s" % (table, ", ".join(unknown)))
+        rows = ([value or None for value in row] for row in reader)
+        if table == "bookings":
+            rows = (normalise_csv_booking(header, row) for row in rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            n_rows += insert_many(table, header, chunk, chunk_size)
+    CACHE.invalidate()
+    report("Imported", n_rows, table, started_at)
+    return n_rows
+
+def export_csv(table, filepath, chunk_size=None):
+    """Write all the users, rooms or bookings in the database to a CSV
+    file, reading them from the database a chunk at a time.
+
+    Return the number of rows exported
+    """
+    if chunk_size is None:
+        chunk_size = BULK_CHUNK_SIZE
+    started_at = time.time()
+    n_rows = 0
+    columns = CSV_COLUMNS[table]
+    rows = iter_select(
+        "SELECT %s FROM %s ORDER BY id" % (", ".join(columns), table),
+        arraysize=chunk_size
+    )
+    with open_csv(filepath, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            n_rows += 1
+    report("Exported", n_rows, table, started_at)
+    return n_rows
+
+#
+# Pages are sent to the browser a chunk at a time as they're built,
+# rather than being built in full first. Small pieces of HTML are
+# gathered into chunks of about this many characters before being sent.
+#
+STREAM_CHUNK_SIZE = 16 * 1024
+
+#
+# When rendering a table or list, how many rows to join together into
+# one piece of HTML at a time.
+#
+RENDER_CHUNK_ROWS = 500
+
+class Template(object):
+    """A piece of HTML with {name} placeholders, like the ones used with
+    str.format. The template is worked out once, when it's created, into
+    a small Python function which joins the fixed text and the values
+    together in one go, so rendering it for each of thousands of rows
+    doesn't mean picking the template apart again every time.
+
+    `defaults` gives the text to use in place of any value which is
+    empty (eg None), as `value or default` would. If `escape` is true,
+    every value is HTML-escaped, quotes included: use that for any
+    template which is filled in with what came in the request.
+    """
+
+    def __init__(self, text, defaults=None, escape=False):
+        if defaults is None:
+            defaults = {}
+        self.text = text
+        wrap = "_escape(%s)" if escape else "%s"
+        pieces = []
+        for literal, name, format_spec, conversion in string.Formatter().parse(text):
+            if literal:
+                pieces.append(repr(literal))
+            if name is None:
+                continue
+            if format_spec or conversion or not name.isidentifier():
+                raise ValueError("Only simple {name} placeholders are supported: %r" % name)
+            if name in defaults:
+                pieces.append(wrap % ("_str(values[%r] or %r)" % (name, defaults[name])))
+            else:
+                pieces.append(wrap % ("_str(values[%r])" % name))
+        source = "def render(values, _str=str, _escape=html.escape):\n    return ''.join((%s,))\n" % ", ".join(pieces or ["''"])
+        namespace = {"html" : html}
+        exec(compile(source, "<template>", "exec"), namespace)
+        self.render = namespace["render"]
+
+    def render_many(self, rows, chunk_rows=None):
+        """Render the template once for each row, generating the HTML
+        RENDER_CHUNK_ROWS rows at a time
+        """
+        if chunk_rows is None:
+            chunk_rows = RENDER_CHUNK_ROWS
+        render = self.render
+        rows = iter(rows)
+        while True:
+            html = "".join([render(row) for row in itertools.islice(rows, chunk_rows)])
+            if not html:
+                break
+            yield html
+
+PAGE_HEADER = Template("""
     <html>
     <head>
     <title>Room Booking System: {title}</title>
@@ -212,10 +2448,157 @@ def page(title, content):
     </head>
     <body>
     <h1>{title}</h1>
-    {content}
+    """)
+PAGE_FOOTER = """
     </body>
     </html>
-    """.format(title=title, content=content)
+    """
+
+USER_ITEM = Template(
+    '<li><a href="/bookings/user/{id}">{name}</a> ({email_address})</li>\n',
+    defaults={"email_address" : "No email"}
+)
+ROOM_ITEM = Template(
+    '<li><a href="/bookings/room/{id}">{name}</a> ({location})</li>\n',
+    defaults={"location" : "Location unknown"}
+)
+OPTION = Template('<option value="{id}">{name}</option>')
+ALL_BOOKINGS_ROW = Template(
+    "<tr><td>{user_name}</td><td>{room_name}</td><td>{booked_on}</td><td>{booked_from} - {booked_to}</td></tr>",
+    defaults={"booked_from" : "", "booked_to" : ""}
+)
+USER_BOOKINGS_ROW = Template(
+    "<tr><td>{room_name}</td><td>{booked_on}</td><td>{booked_from} - {booked_to}</td></tr>",
+    defaults={"booked_from" : "", "booked_to" : ""}
+)
+ROOM_BOOKINGS_ROW = Template(
+    "<tr><td>{user_name}</td><td>{booked_on}</td><td>{booked_from} - {booked_to}</td></tr>",
+    defaults={"booked_from" : "", "booked_to" : ""}
+)
+BOOKING_TIMES = Template(
+    '<label for="booked_on">On</label>&nbsp;<input type="text" name="booked_on" value="{booked_on}"/>'
+    '&nbsp;<label for="booked_from">between</label>&nbsp;<input type="text" name="booked_from" value="{booked_from}"/>'
+    '&nbsp;<label for="booked_to">and</label>&nbsp;<input type="text" name="booked_to" value="{booked_to}"/>'
+    '<input type="submit" name="submit" value="Add Booking"/></form>',
+    defaults={"booked_from" : "", "booked_to" : ""}
+)
+NEXT_FREE_FORM = Template(
+    '<form method="GET" action="/bookings/room/{room_id}">'
+    '<label for="duration">Find the next free</label>&nbsp;<input type="text" name="duration" value="{duration}" size="4"/>'
+    '&nbsp;minutes <input type="submit" value="Find"/></form>'
+)
+
+def booking_times(booked_on=None, booked_from=None, booked_to=None):
+    """Return the date and time fields of a booking form, and its submit
+    button, filled in with the given date (today by default) and times
+    """
+    return BOOKING_TIMES.render({
+        "booked_on" : booked_on or datetime.date.today(),
+        "booked_from" : booked_from,
+        "booked_to" : booked_to
+    })
+
+def user_options():
+    """Return the <option> list of all the users, as encoded HTML. It's
+    rendered once and kept in CACHE, so it's made again only after the
+    users have changed.
+    """
+    return CACHE.get(("options", "users"), lambda: "".join(OPTION.render_many(get_users())).encode("utf-8"))
+
+def room_options():
+    """Return the <option> list of all the rooms, as encoded HTML. It's
+    rendered once and kept in CACHE, so it's made again only after the
+    rooms have changed.
+    """
+    return CACHE.get(("options", "rooms"), lambda: "".join(OPTION.render_many(get_rooms())).encode("utf-8"))
+
+#
+# The booking forms offer a drop-down of every user or room until there
+# are more than PICKER_LIMIT of them. After that they have a text box
+# instead, which looks names up as they're typed through
+# /api/users/search or /api/rooms/search.
+#
+PICKER_LIMIT = 500
+
+TYPEAHEAD = Template(
+    '<input type="text" name="{name}" list="{name}_list" autocomplete="off" data-search="{url}"/>'
+    '<datalist id="{name}_list"></datalist>'
+)
+TYPEAHEAD_SCRIPT = """<script>
+if (!window.typeahead) {
+    window.typeahead = true;
+    document.addEventListener("input", function (event) {
+        var input = event.target, url = input.getAttribute("data-search");
+        if (!url || !input.value) return;
+        fetch(url + "?q=" + encodeURIComponent(input.value)).then(function (response) {
+            return response.json();
+        }).then(function (rows) {
+            var list = document.getElementById(input.getAttribute("list"));
+            list.innerHTML = "";
+            rows.forEach(function (row) {
+                var option = document.createElement("option");
+                option.value = row.id;
+                option.textContent = row.name;
+                list.appendChild(option);
+            });
+        });
+    });
+}
+</script>"""
+
+def user_picker():
+    """Return the form field for choosing a user: a drop-down of all the
+    users or, if there are too many, a text box which searches them
+    """
+    if len(get_users()) > PICKER_LIMIT:
+        return TYPEAHEAD.render({"name" : "user_id", "url" : "/api/users/search"}) + TYPEAHEAD_SCRIPT
+    return b'<select name="user_id">' + user_options() + b'</select>'
+
+def room_picker():
+    """Return the form field for choosing a room: a drop-down of all the
+    rooms or, if there are too many, a text box which searches them
+    """
+    if len(get_rooms()) > PICKER_LIMIT:
+        return TYPEAHEAD.render({"name" : "room_id", "url" : "/api/rooms/search"}) + TYPEAHEAD_SCRIPT
+    return b'<select name="room_id">' + room_options() + b'</select>'
+
+def page(title, content):
+    """Generate a complete HTML page with the title as the <title> and <h1>
+    tags, and the content within the body, after the <h1>
+
+    The content can be a string or any iterable of strings, eg a generator
+    which produces the page a row at a time. The pieces are gathered into
+    chunks of about STREAM_CHUNK_SIZE which are handed on as soon as they're
+    ready, so the start of a long page can be sent before the end of it
+    has been read from the database.
+
+    A piece can also be bytes of already-encoded HTML, such as the cached
+    <option> lists; those are spliced into the page as they are. The
+    chunks are produced as UTF-8 bytes, ready to send.
+    """
+    if isinstance(content, str):
+        content = [content]
+
+    encoded = []
+    buffer = [PAGE_HEADER.render({"title" : title})]
+    size = len(buffer[0])
+    for piece in content:
+        if isinstance(piece, bytes):
+            encoded.append("".join(buffer).encode("utf-8"))
+            encoded.append(piece)
+            buffer = []
+        else:
+            buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE:
+            encoded.append("".join(buffer).encode("utf-8"))
+            yield b"".join(encoded)
+            encoded = []
+            buffer = []
+            size = 0
+    buffer.append(PAGE_FOOTER)
+    encoded.append("".join(buffer).encode("utf-8"))
+    yield b"".join(encoded)
 
 def index_page(environ):
     """Provide a list of all the pages
@@ -225,6 +2608,8 @@ def index_page(environ):
         <li><a href="/users">Users</a></li>
         <li><a href="/rooms">Rooms</a></li>
         <li><a href="/bookings">Bookings</a></li>
+        <li><a href="/available">Available rooms</a></li>
+        <li><a href="/search">Search bookings</a></li>
     </ul>
     """
     return page("Starting Page", html)
@@ -232,173 +2617,549 @@ def index_page(environ):
 def users_page(environ):
     """Provide a list of all the users, linking to their bookings
     """
-    html = "<ul>"
-    for user in get_users():
-        html += '<li><a href="/bookings/user/{id}">{name}</a> ({email_address})</li>\n'.format(
-            id=user['id'],
-            name=user['name'],
-            email_address=user['email_address'] or "No email"
-        )
-    html += "</ul>"
-    html += "<hr/>"
-    html += """<form method="POST" action="/add-user">
+    def content():
+        yield "<ul>"
+        for html in USER_ITEM.render_many(get_users()):
+            yield html
+        yield "</ul>"
+        yield "<hr/>"
+        yield """<form method="POST" action="/add-user">
     <label for="name">Name:</label>&nbsp;<input type="text" name="name"/>
     <label for="email_address">Email:</label>&nbsp;<input type="text" name="email_address"/>
     <input type="submit" name="submit" value="Add User"/>
     </form>"""
-    return page("Users", html)
+    return page("Users", content())
 
 def rooms_page(environ):
     """Provide a list of all the rooms, linking to their bookings
     """
-    html = "<ul>"
-    for room in get_rooms():
-        html += '<li><a href="/bookings/room/{id}">{name}</a> ({location})</li>\n'.format(
-            id=room['id'],
-            name=room['name'],
-            location=room['location'] or "Location unknown"
-        )
-    html += "</ul>"
-    html += "<hr/>"
-    html += """<form method="POST" action="/add-room">
+    def content():
+        yield "<ul>"
+        for html in ROOM_ITEM.render_many(get_rooms()):
+            yield html
+        yield "</ul>"
+        yield "<hr/>"
+        yield """<form method="POST" action="/add-room">
     <label for="name">Name:</label>&nbsp;<input type="text" name="name"/>
     <label for="location">Location:</label>&nbsp;<input type="text" name="location"/>
     <input type="submit" name="submit" value="Add Room"/>
     </form>"""
-    return page("Rooms", html)
+    return page("Rooms", content())
+
+def key_query(name, booking):
+    """Return the query string which gives the key of a booking (see
+    booking_key) as name_on, name_from and name_id. With no start time,
+    there's no name_from at all, to tell it apart from an empty one.
+    """
+    booked_on, booked_from, id = booking_key(booking)
+    fields = [(name + "_on", booked_on)]
+    if booked_from is not None:
+        fields.append((name + "_from", booked_from))
+    fields.append((name + "_id", id))
+    return urllib.parse.urlencode(fields)
+
+def key_from_query(query, name):
+    """Read back the key of a booking written into the query string by
+    key_query, or None if it isn't there
+    """
+    try:
+        id = int(query.getfirst(name + "_id"))
+    except (TypeError, ValueError):
+        return None
+    return query.getfirst(name + "_on", ""), query.getfirst(name + "_from"), id
+
+DATE_RANGE_FORM = Template(
+    '<form method="GET" action="{path}">'
+    '<label for="from">From</label>&nbsp;<input type="text" name="from" value="{start}"/>'
+    '&nbsp;<label for="to">to</label>&nbsp;<input type="text" name="to" value="{end}"/>'
+    '<input type="submit" value="Show"/></form>',
+    defaults={"start" : "", "end" : ""},
+    escape=True
+)
+
+def date_range(query):
+    """Read the from and to dates in the query string. With no from
+    date, start from today; an empty one means from the beginning.
+    """
+    start = query.getfirst("from")
+    if start is None:
+        start = str(datetime.date.today())
+    return start or None, query.getfirst("to") or None
+
+def page_of_bookings(environ, room_id=None, user_id=None):
+    """Read the page of bookings asked for in the query string, between
+    the dates it gives (see date_range), through get_bookings_between.
+    Return the bookings and the HTML of the date range form and of the
+    links to the pages before and after.
+    """
+    query = parse_query(environ)
+    start, end = date_range(query)
+    after = key_from_query(query, "after")
+    before = key_from_query(query, "before")
+    #
+    # Ask for one more than fits on the page, to know if there's
+    # another page beyond it
+    #
+    bookings = get_bookings_between(
+        start, end, room_id, user_id,
+        limit=BOOKINGS_PAGE_SIZE + 1, after=after, before=before
+    )
+    more = len(bookings) > BOOKINGS_PAGE_SIZE
+    if before is not None:
+        bookings = bookings[-BOOKINGS_PAGE_SIZE:]
+        has_previous, has_next = more, True
+    else:
+        bookings = bookings[:BOOKINGS_PAGE_SIZE]
+        has_previous, has_next = after is not None, more
+
+    #
+    # The links keep everything else in the query string, such as the
+    # dates, and replace just the key of the booking to start from.
+    #
+    path = environ.get("PATH_INFO", "")
+    keep = urllib.parse.urlencode([
+        (name, value) for name in query for value in query[name]
+        if not name.startswith(("after_", "before_"))
+    ], doseq=True)
+    links = []
+    if bookings and has_previous:
+        links.append('<a href="{0}?{1}">Previous</a>'.format(path, "&".join(filter(None, [keep, key_query("before", bookings[0])]))))
+    if bookings and has_next:
+        links.append('<a href="{0}?{1}">Next</a>'.format(path, "&".join(filter(None, [keep, key_query("after", bookings[-1])]))))
+    form = DATE_RANGE_FORM.render({"path" : path, "start" : start, "end" : end})
+    return bookings, form, "&nbsp;".join(links)
 
 def all_bookings_page(environ):
-    """Provide a list of all bookings
-    """
-    html = "<table>"
-    html += "<tr><td>Room</td><td>User</td><td>Date</td><td>Times</td></tr>"
-    for booking in get_bookings():
-        html += "<tr><td>{user_name}</td><td>{room_name}</td><td>{booked_on}</td><td>{booked_from} - {booked_to}</td></tr>".format(
-            user_name=booking['user_name'],
-            room_name=booking['room_name'],
-            booked_on=booking['booked_on'],
-            booked_from=booking['booked_from'] or "",
-            booked_to=booking['booked_to'] or ""
-        )
-    html += "</table>"
+    """Provide a list of all bookings, a page at a time, from today on
+    unless other dates are given
+    """
+    bookings, form, links = page_of_bookings(environ)
+    def content():
+        yield form
+        yield "<table>"
+        yield "<tr><td>Room</td><td>User</td><td>Date</td><td>Times</td></tr>"
+        for html in ALL_BOOKINGS_ROW.render_many(bookings):
+            yield html
+        yield "</table>"
+        yield links
 
-    html += "<hr/>"
-    html += '<form method="POST" action="/add-booking">'
+        yield "<hr/>"
+        yield '<form method="POST" action="/add-booking">'
 
-    html += '<label for="user_id">User:</label>&nbsp;<select name="user_id">'
-    for user in get_users():
-        html += '<option value="{id}">{name}</option>'.format(**user)
-    html += '</select>'
+        yield '<label for="user_id">User:</label>&nbsp;'
+        yield user_picker()
 
-    html += '&nbsp;|&nbsp;'
+        yield '&nbsp;|&nbsp;'
 
-    html += '<label for="room_id">Room:</label>&nbsp;<select name="room_id">'
-    for room in get_rooms():
-        html += '<option value="{id}">{name}</option>'.format(**room)
-    html += '</select>'
+        yield '<label for="room_id">Room:</label>&nbsp;'
+        yield room_picker()
 
-    html += '&nbsp;|&nbsp;'
-    html += '<label for="booked_on">On</label>&nbsp;<input type="text" name="booked_on" value="{today}"/>'.format(today=datetime.date.today())
-    html += '&nbsp;<label for="booked_from">between</label>&nbsp;<input type="text" name="booked_from" />'
-    html += '&nbsp;<label for="booked_to">and</label>&nbsp;<input type="text" name="booked_to" />'
-    html += '<input type="submit" name="submit" value="Add Booking"/></form>'
+        yield '&nbsp;|&nbsp;'
+        yield booking_times()
 
-    return page("All Bookings", html)
+    return page("All Bookings", content())
 
 
-def bookings_user_page(environ):
-    """Provide a list of bookings by user, showing room and date/time
+def bookings_user_page(environ, user_id):
+    """Provide a list of bookings by user, showing room and date/time,
+    a page at a time, from today on unless other dates are given
     """
-    user_id = int(shift_path_info(environ))
     user = get_user(user_id)
-    html = "<table>"
-    html += "<tr><td>Room</td><td>Date</td><td>Times</td></tr>"
-    for booking in get_bookings_for_user(user_id):
-        html += "<tr><td>{room_name}</td><td>{booked_on}</td><td>{booked_from} - {booked_to}</td></tr>".format(
-            room_name=booking['room_name'],
-            booked_on=booking['booked_on'],
-            booked_from=booking['booked_from'] or "",
-            booked_to=booking['booked_to'] or ""
-        )
-    html += "</table>"
-    html += "<hr/>"
-    html += '<form method="POST" action="/add-booking">'
-    html += '<input type="hidden" name="user_id" value="{user_id}"/>'.format(user_id=user_id)
-    html += '<label for="room_id">Room:</label>&nbsp;<select name="room_id">'
-    for room in get_rooms():
-        html += '<option value="{id}">{name}</option>'.format(**room)
-    html += '</select>'
-    html += '&nbsp;|&nbsp;'
-    html += '<label for="booked_on">On</label>&nbsp;<input type="text" name="booked_on" value="{today}"/>'.format(today=datetime.date.today())
-    html += '&nbsp;<label for="booked_from">between</label>&nbsp;<input type="text" name="booked_from" />'
-    html += '&nbsp;<label for="booked_to">and</label>&nbsp;<input type="text" name="booked_to" />'
-    html += '<input type="submit" name="submit" value="Add Booking"/></form>'
-    return page("Bookings for %s" % user['name'], html)
-
-def bookings_room_page(environ):
-    """Provide a list of bookings by room, showing user and date/time
-    """
-    room_id = int(shift_path_info(environ))
+    if user is None:
+        return Response("404 Not Found", "Not Found: %s" % environ.get('PATH_INFO', ''))
+    bookings, form, links = page_of_bookings(environ, user_id=user_id)
+    def content():
+        yield form
+        yield "<table>"
+        yield "<tr><td>Room</td><td>Date</td><td>Times</td></tr>"
+        for html in USER_BOOKINGS_ROW.render_many(bookings):
+            yield html
+        yield "</table>"
+        yield links
+        yield "<hr/>"
+        yield '<form method="POST" action="/add-booking">'
+        yield '<input type="hidden" name="user_id" value="{user_id}"/>'.format(user_id=user_id)
+        yield '<label for="room_id">Room:</label>&nbsp;'
+        yield room_picker()
+        yield '&nbsp;|&nbsp;'
+        yield booking_times()
+    return page("Bookings for %s" % user['name'], content())
+
+def bookings_room_page(environ, room_id):
+    """Provide a list of bookings by room, showing user and date/time,
+    a page at a time, from today on unless other dates are given
+
+    If a duration (in minutes) is given in the query string, find the
+    next time the room is free for that long and fill it in on the form.
+    """
     room = get_room(room_id)
-    html = "<table>"
-    html += "<tr><td>User</td><td>Date</td><td>Times</td></tr>"
-    for booking in get_bookings_for_room(room_id):
-        html += "<tr><td>{user_name}</td><td>{booked_on}</td><td>{booked_from} - {booked_to}</td></tr>".format(
-            user_name=booking['user_name'],
-            booked_on=booking['booked_on'],
-            booked_from=booking['booked_from'] or "",
-            booked_to=booking['booked_to'] or ""
+    if room is None:
+        return Response("404 Not Found", "Not Found: %s" % environ.get('PATH_INFO', ''))
+    bookings, form, links = page_of_bookings(environ, room_id=room_id)
+    query = parse_query(environ)
+    try:
+        duration = int(query.getfirst("duration") or 0)
+    except ValueError:
+        duration = 0
+    def content():
+        yield form
+        yield "<table>"
+        yield "<tr><td>User</td><td>Date</td><td>Times</td></tr>"
+        for html in ROOM_BOOKINGS_ROW.render_many(bookings):
+            yield html
+        yield "</table>"
+        yield links
+        yield "<hr/>"
+        yield NEXT_FREE_FORM.render({"room_id" : room_id, "duration" : duration or 60})
+        free_slot = None
+        if duration > 0:
+            free_slot = find_next_free_slot(room_id, duration)
+            if free_slot:
+                yield "<p>Next free: {0} from {1} to {2}</p>".format(*free_slot)
+            else:
+                yield "<p>No free time that long found</p>"
+        yield '<form method="POST" action="/add-booking">'
+        yield '<input type="hidden" name="room_id" value="{room_id}"/>'.format(room_id=room_id)
+        yield '<label for="user_id">User:</label>&nbsp;'
+        yield user_picker()
+        yield '&nbsp;|&nbsp;'
+        if free_slot:
+            yield booking_times(*free_slot)
+        else:
+            yield booking_times()
+    return page("Bookings for %s" % room['name'], content())
+
+AVAILABLE_FORM = Template(
+    '<form method="GET" action="/available">'
+    '<label for="booked_on">On</label>&nbsp;<input type="text" name="booked_on" value="{booked_on}"/>'
+    '&nbsp;<label for="booked_from">between</label>&nbsp;<input type="text" name="booked_from" value="{booked_from}"/>'
+    '&nbsp;<label for="booked_to">and</label>&nbsp;<input type="text" name="booked_to" value="{booked_to}"/>'
+    '<input type="submit" value="Find Rooms"/></form>',
+    defaults={"booked_from" : "", "booked_to" : ""},
+    escape=True
+)
+
+SEARCH_FORM = Template(
+    '<form method="GET" action="/search">'
+    '<input type="text" name="q" value="{q}"/>'
+    '<input type="submit" value="Search"/></form>',
+    escape=True
+)
+
+def search_page(environ):
+    """Provide the bookings matching a search of users and rooms, a page
+    at a time, with links to the pages before and after
+    """
+    query = parse_query(environ)
+    text = query.getfirst("q", "")
+    try:
+        page_number = max(int(query.getfirst("page") or 1), 1)
+    except ValueError:
+        page_number = 1
+    #
+    # Ask for one more than fits on the page, to know if there's a next
+    #
+    bookings = search(text, SEARCH_PAGE_SIZE + 1, (page_number - 1) * SEARCH_PAGE_SIZE)
+    def content():
+        yield SEARCH_FORM.render({"q" : text})
+        if not text.strip():
+            return
+        yield "<hr/>"
+        yield "<table>"
+        yield "<tr><td>Room</td><td>User</td><td>Date</td><td>Times</td></tr>"
+        for html in ALL_BOOKINGS_ROW.render_many(bookings[:SEARCH_PAGE_SIZE]):
+            yield html
+        yield "</table>"
+        if page_number > 1:
+            yield '<a href="/search?{0}">Previous</a> '.format(urllib.parse.urlencode({"q" : text, "page" : page_number - 1}))
+        if len(bookings) > SEARCH_PAGE_SIZE:
+            yield '<a href="/search?{0}">Next</a>'.format(urllib.parse.urlencode({"q" : text, "page" : page_number + 1}))
+    return page("Search bookings", content())
+
+def available_page(environ):
+    """Provide a list of the rooms which are free at a given time,
+    linking to their bookings. A date or time which can't be read is
+    answered with 400 and the form again.
+    """
+    query = parse_query(environ)
+    when = {
+        "booked_on" : query.getfirst("booked_on") or str(datetime.date.today()),
+        "booked_from" : query.getfirst("booked_from") or None,
+        "booked_to" : query.getfirst("booked_to") or None,
+    }
+    try:
+        booked_on, booked_from, booked_to = normalise_booking(when["booked_on"], when["booked_from"], when["booked_to"])
+    except BadBookingTimes as exc:
+        return Response(
+            "400 Bad Request",
+            page("Rooms available", [AVAILABLE_FORM.render(when), "<p>%s</p>" % html.escape(str(exc))])
         )
-    html += "</table>"
-    html += "<hr/>"
-    html += '<form method="POST" action="/add-booking">'
-    html += '<input type="hidden" name="room_id" value="{room_id}"/>'.format(room_id=room_id)
-    html += '<label for="user_id">User:</label>&nbsp;<select name="user_id">'
-    for user in get_users():
-        html += '<option value="{id}">{name}</option>'.format(**user)
-    html += '</select>'
-    html += '&nbsp;|&nbsp;'
-    html += '<label for="booked_on">On</label>&nbsp;<input type="text" name="booked_on" value="{today}"/>'.format(today=datetime.date.today())
-    html += '&nbsp;<label for="booked_from">between</label>&nbsp;<input type="text" name="booked_from" />'
-    html += '&nbsp;<label for="booked_to">and</label>&nbsp;<input type="text" name="booked_to" />'
-    html += '<input type="submit" name="submit" value="Add Booking"/></form>'
-    return page("Bookings for %s" % room['name'], html)
-
-def bookings_page(environ):
-    """Provide a list of all bookings by a user or room, showing
-    the other thing (room or user) and the date/time
-    """
-    category = shift_path_info(environ)
-    if not category:
-        return all_bookings_page(environ)
-    elif category == "user":
-        return bookings_user_page(environ)
-    elif category == "room":
-        return bookings_room_page(environ)
-    else:
-        return "No such booking category"
+    def content():
+        yield AVAILABLE_FORM.render(when)
+        yield "<hr/>"
+        yield "<ul>"
+        for html in ROOM_ITEM.render_many(find_available_rooms(booked_on, booked_from, booked_to)):
+            yield html
+        yield "</ul>"
+    return page("Rooms available on %s" % booked_on, content())
+
+class Response(object):
+    """What a page function returns when it needs something other than
+    a plain "200 OK" HTML page: a different status, extra headers or
+    both. (Most page functions just return the content.)
+    """
+    def __init__(self, status, content="", headers=None):
+        self.status = status
+        self.content = content
+        self.headers = headers or []
+
+def redirect(location):
+    return Response("301 Redirect", headers=[("Location", location)])
+
+#
+# The largest form submission, in bytes, which we'll read
+#
+MAX_FORM_SIZE = 64 * 1024
+
+class FormTooLarge(Exception):
+    pass
+
+class BadForm(Exception):
+    pass
+
+class UnsupportedFormType(BadForm):
+    pass
+
+class Form(dict):
+    """The fields of a submitted form, with each name mapped to the list
+    of values given for it
+    """
+    def getfirst(self, name, default=None):
+        """Return the first value given for name, or default if it
+        wasn't given at all
+        """
+        values = self.get(name)
+        if values:
+            return values[0]
+        return default
+
+    def getlist(self, name):
+        return self.get(name, [])
+
+def parse_form(environ, max_size=None):
+    """Read the fields of a form submitted with POST. Exactly as many
+    bytes as the browser says it's sending are read, and a submission
+    bigger than max_size (MAX_FORM_SIZE by default) is refused with
+    FormTooLarge without reading it.
+
+    Only ordinary (application/x-www-form-urlencoded) forms are
+    understood, which is what all the forms here send; anything else is
+    refused with UnsupportedFormType. A length which isn't a whole
+    number of bytes is refused with BadForm. Empty fields are kept, as
+    empty strings, and anything which isn't valid UTF-8 is replaced
+    rather than refused.
+    """
+    if max_size is None:
+        max_size = MAX_FORM_SIZE
+    try:
+        content_length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        raise BadForm("Form length %r isn't a number" % environ.get("CONTENT_LENGTH"))
+    if content_length < 0:
+        raise BadForm("Form length %d is less than nothing" % content_length)
+    if content_length > max_size:
+        raise FormTooLarge("Form of %d bytes is larger than %d" % (content_length, max_size))
+
+    content_type = environ.get("CONTENT_TYPE", "").split(";")[0].strip().lower()
+    if content_type not in ("", "application/x-www-form-urlencoded"):
+        raise UnsupportedFormType("Can't read a form sent as %s" % content_type)
+
+    #
+    # Every byte is a valid latin-1 character, so this can't fail; the
+    # %-escapes, which are how a browser sends anything but plain ASCII,
+    # are read as UTF-8 by parse_qs.
+    #
+    body = environ["wsgi.input"].read(content_length) if content_length else b""
+    return Form(urllib.parse.parse_qs(
+        body.decode("latin-1"), keep_blank_values=True, encoding="utf-8", errors="replace"
+    ))
+
+def parse_query(environ):
+    """Read the fields given in the query string of the URL (everything
+    after the "?"), eg by a form submitted with GET
+    """
+    return Form(urllib.parse.parse_qs(environ.get("QUERY_STRING", ""), keep_blank_values=True))
 
 def add_user(environ):
-    form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ.copy(), keep_blank_values=True)
+    form = parse_form(environ)
     add_user_to_database(form.getfirst("name"), form.getfirst('email_address', ""))
+    return redirect("/users")
 
 def add_room(environ):
-    form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ.copy(), keep_blank_values=True)
+    form = parse_form(environ)
     add_room_to_database(form.getfirst("name"), form.getfirst('location', None))
+    return redirect("/rooms")
 
 def add_booking(environ):
-    form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ.copy(), keep_blank_values=True)
-    add_booking_to_database(
-        form.getfirst("user_id"),
-        form.getfirst("room_id"),
-        form.getfirst("booked_on"),
-        form.getfirst("booked_from"),
-        form.getfirst("booked_to")
+    form = parse_form(environ)
+    referer = environ.get("HTTP_REFERER", "/bookings")
+    #
+    # With the typeahead pickers the ids are typed in, so they may be
+    # anything at all: make sure they're the ids of a real user and room.
+    #
+    try:
+        user_id = int(form.getfirst("user_id"))
+        room_id = int(form.getfirst("room_id"))
+    except (TypeError, ValueError):
+        user_id = room_id = None
+    if user_id is None or get_user(user_id) is None or get_room(room_id) is None:
+        return Response(
+            "400 Bad Request",
+            page("No such user or room", '<p>Choose a user and a room from the lists</p><p><a href="{referer}">Back</a></p>'.format(
+                referer=html.escape(referer)
+            ))
+        )
+    try:
+        add_booking_to_database(
+            user_id,
+            room_id,
+            form.getfirst("booked_on"),
+            form.getfirst("booked_from") or None,
+            form.getfirst("booked_to") or None
+        )
+    except BadBookingTimes as exc:
+        return Response(
+            "400 Bad Request",
+            page("Can't book those times", '<p>{message}</p><p><a href="{referer}">Back</a></p>'.format(
+                message=html.escape(str(exc)), referer=html.escape(referer)
+            ))
+        )
+    except BookingConflict as exc:
+        return Response(
+            "409 Conflict",
+            page("Room already booked", '<p>{message}</p><p><a href="{referer}">Back</a></p>'.format(
+                message=html.escape(str(exc)), referer=html.escape(referer)
+            ))
+        )
+    return redirect(referer)
+
+#
+# Searches for the typeahead pickers return at most SEARCH_MAX_LIMIT
+# matches, and SEARCH_LIMIT unless asked for some other number.
+#
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+def search_response(environ, index):
+    """Answer a search for the typeahead pickers: the q, limit and
+    offset in the query string are passed to index.search and the
+    matching rows are returned as a JSON list of objects
+    """
+    query = parse_query(environ)
+    try:
+        limit = int(query.getfirst("limit") or SEARCH_LIMIT)
+        offset = int(query.getfirst("offset") or 0)
+    except ValueError:
+        return Response("400 Bad Request", "limit and offset must be whole numbers")
+    limit = min(max(limit, 1), SEARCH_MAX_LIMIT)
+    rows = index.search(query.getfirst("q", ""), limit, max(offset, 0))
+    return Response(
+        "200 OK",
+        json.dumps([dict(zip(row.keys(), row)) for row in rows]),
+        [("Content-type", "application/json")]
     )
 
+def search_users(environ):
+    return search_response(environ, user_index())
+
+def search_rooms(environ):
+    return search_response(environ, room_index())
+
+class Router(object):
+    """Find the function which serves a URL. Each route is a method, a
+    path and a function, eg:
+
+        ("GET", "/bookings/room/<int:room_id>", bookings_room_page)
+
+    A segment of the path in <angle brackets> matches any value of the
+    given type (int or str) and is passed to the function as a keyword
+    argument, after the WSGI environment.
+
+    The routes are sorted by the first segment of their path when the
+    router is made, so finding a URL means looking up that segment in
+    a dictionary and then checking just the few routes which share it.
+    The first segment of a route must be fixed text for that reason.
+    """
+
+    converters = {"int" : int, "str" : str}
+
+    def __init__(self, routes):
+        self.routes = {}
+        for method, pattern, function in routes:
+            segments = []
+            for segment in pattern.strip("/").split("/"):
+                if segment.startswith("<") and segment.endswith(">"):
+                    type_name, name = segment[1:-1].split(":")
+                    segments.append((self.converters[type_name], name))
+                else:
+                    segments.append((None, segment))
+            if segments[0][0] is not None:
+                raise ValueError("The first segment of %s must be fixed" % pattern)
+            self.routes.setdefault(segments[0][1], []).append((method, segments[1:], function))
+
+    def match(self, method, path):
+        """Return the function for this method and path, along with the
+        values picked out of the path, and a list of the methods which
+        the path would have accepted. If there's no function, it's None:
+        if the list of methods is empty too, there's no such page.
+        """
+        if method == "HEAD":
+            method = "GET"
+        first, *rest = path.strip("/").split("/")
+        allowed = []
+        for route_method, segments, function in self.routes.get(first, []):
+            if len(segments) != len(rest):
+                continue
+            params = {}
+            for (convert, name), value in zip(segments, rest):
+                if convert is None:
+                    if value != name:
+                        break
+                else:
+                    try:
+                        params[name] = convert(value)
+                    except ValueError:
+                        break
+            else:
+                if route_method == method:
+                    return function, params, [route_method]
+                allowed.append(route_method)
+        return None, {}, allowed
+
+ROUTER = Router([
+    ("GET", "/", index_page),
+    ("GET", "/users", users_page),
+    ("GET", "/rooms", rooms_page),
+    ("GET", "/bookings", all_bookings_page),
+    ("GET", "/bookings/user/<int:user_id>", bookings_user_page),
+    ("GET", "/bookings/room/<int:room_id>", bookings_room_page),
+    ("GET", "/available", available_page),
+    ("GET", "/search", search_page),
+    ("GET", "/api/users/search", search_users),
+    ("GET", "/api/rooms/search", search_rooms),
+    ("POST", "/add-user", add_user),
+    ("POST", "/add-room", add_room),
+    ("POST", "/add-booking", add_booking),
+])
+
 def webapp(environ, start_response):
     """Serve simple pages, based on whether the URL requests
-    users, rooms or bookings. For now, just serve the Home page
+    users, rooms or bookings, by finding the page function for the URL
+    in ROUTER.
+
+    The page is sent as it's generated, a chunk at a time, so this
+    function is itself a generator: the WSGI server asks it for the next
+    chunk when it's ready to send more.
     """
     setup_testing_defaults(environ)
 
@@ -407,55 +3168,494 @@ def webapp(environ, start_response):
     #
     status = '200 OK'
     headers = [('Content-type', 'text/html; charset=utf-8')]
+
     #
-    # Pick up the first segment on the path and pass
-    # the rest along.
-    #
-    # ie if we're looking for /users/1/bookings,
-    # param1 will be "users", and the remaining path will
-    # be "/1/bookings".
-    #
-    param1 = shift_path_info(environ)
-    if param1 == "":
-        data = index_page(environ)
-    elif param1 == "users":
-        data = users_page(environ)
-    elif param1 == "rooms":
-        data = rooms_page(environ)
-    elif param1 == "bookings":
-        data = bookings_page(environ)
-    elif param1 == "add-user":
-        add_user(environ)
-        status = "301 Redirect"
-        headers.append(("Location", "/users"))
-        data = ""
-    elif param1 == "add-room":
-        add_room(environ)
-        status = "301 Redirect"
-        headers.append(("Location", "/rooms"))
-        data = ""
-    elif param1 == "add-booking":
-        add_booking(environ)
-        status = "301 Redirect"
-        headers.append(("Location", environ.get("HTTP_REFERER", "/bookings")))
-        data = ""
+    # Pages which only read from the database see one consistent
+    # snapshot of it for the whole of the request, including the time
+    # spent sending the page.
+    #
+    method = environ['REQUEST_METHOD']
+    with request_context(snapshot=method in ("GET", "HEAD")):
+        path = environ.get('PATH_INFO', '')
+        function, params, allowed = ROUTER.match(method, path)
+        if function is not None:
+            try:
+                data = function(environ, **params)
+            except FormTooLarge as exc:
+                data = Response("413 Request Entity Too Large", str(exc))
+            except UnsupportedFormType as exc:
+                data = Response("415 Unsupported Media Type", str(exc))
+            except BadForm as exc:
+                data = Response("400 Bad Request", str(exc))
+        elif allowed:
+            data = Response("405 Method Not Allowed", "Method Not Allowed: %s" % method, [("Allow", ", ".join(allowed))])
+        else:
+            data = Response("404 Not Found", "Not Found: %s" % path)
+
+        if isinstance(data, Response):
+            status = data.status
+            replaced = set(name.lower() for name, value in data.headers)
+            headers = [header for header in headers if header[0].lower() not in replaced]
+            headers.extend(data.headers)
+            data = data.content
+
+        start_response(status, headers)
+        if isinstance(data, str):
+            data = [data]
+        for chunk in data:
+            yield chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+
+#
+# The website can be served in several ways:
+#
+# single   - one request at a time (the simplest, and the default)
+# threaded - a new thread for every request
+# pool     - a fixed number of worker threads, fed from a queue of at
+#            most SERVER_QUEUE_SIZE waiting requests
+# prefork  - a fixed number of worker processes, all accepting requests
+#            from the same socket (not available on Windows)
+# async    - an asyncio event loop handling every connection, with the
+#            pages themselves (and so the database) running on a fixed
+#            number of worker threads
+#
+SERVER_MODES = ["single", "threaded", "pool", "prefork", "async"]
+SERVER_PORT = 8000
+SERVER_WORKERS = 4
+SERVER_BACKLOG = 64
+SERVER_QUEUE_SIZE = 32
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """Serve each request in a thread of its own
+    """
+    daemon_threads = True
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """Serve requests from a fixed number of worker threads. Accepted
+    connections wait in a queue until a worker is free; when the queue
+    is full, the server stops accepting until there's room, leaving
+    new connections to wait in the socket's backlog instead.
+    """
+
+    def start_workers(self, workers, queue_size):
+        self.requests = queue.Queue(queue_size)
+        for n in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+def enable_concurrent_access():
+    """Switch the database into write-ahead-log mode, where people
+    reading from the database don't hold up someone writing to it or
+    vice versa. The setting is stored in the database file, so this
+    only really does anything the first time.
+    """
+    db = sqlite3.connect(DATABASE_FILEPATH, timeout=BUSY_TIMEOUT)
+    try:
+        db.execute("PRAGMA journal_mode = WAL")
+    finally:
+        db.close()
+
+def make_website_server(mode="single", port=SERVER_PORT, workers=SERVER_WORKERS, backlog=SERVER_BACKLOG):
+    """Create (but don't start) a web server in one of the SERVER_MODES
+    """
+    if mode not in SERVER_MODES:
+        raise ValueError("mode must be one of %s" % ", ".join(SERVER_MODES))
+    if mode == "threaded":
+        server_class = ThreadingWSGIServer
+    elif mode == "pool":
+        server_class = ThreadPoolWSGIServer
     else:
-        status = '404 Not Found'
-        data = "Not Found: %s" % param1
+        server_class = WSGIServer
+
+    #
+    # The backlog has to be set before the server starts listening,
+    # so bind and activate it ourselves.
+    #
+    httpd = server_class(('', port), WSGIRequestHandler, bind_and_activate=False)
+    httpd.request_queue_size = backlog
+    try:
+        httpd.server_bind()
+        httpd.server_activate()
+    except:
+        httpd.server_close()
+        raise
+    httpd.set_app(webapp)
+    if mode == "pool":
+        httpd.start_workers(workers, SERVER_QUEUE_SIZE)
+    return httpd
+
+def serve_preforked(httpd, workers):
+    """Fork worker processes which all serve requests from the server's
+    socket, then wait for them. A worker which dies is replaced.
+    """
+    #
+    # A sqlite connection mustn't be carried across a fork, so make sure
+    # this process has none open for the workers to inherit. Each worker
+    # opens its own as it needs them.
+    #
+    POOL.close_all()
+
+    children = set()
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                httpd.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    for n in range(workers):
+        start_worker()
+    try:
+        while children:
+            pid, status = os.wait()
+            children.discard(pid)
+            start_worker()
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+#
+# The asyncio server keeps an idle keep-alive connection open for this
+# many seconds, and allows request headers of at most this many bytes.
+# Once the headers are in, the body (no bigger than MAX_FORM_SIZE) has
+# to arrive within ASYNC_BODY_TIMEOUT seconds. At most ASYNC_SEND_BUFFER
+# chunks of a page are kept waiting for a slow browser, and one which
+# takes nothing for ASYNC_SEND_TIMEOUT seconds is given up on.
+#
+ASYNC_KEEPALIVE_TIMEOUT = 75
+ASYNC_MAX_HEADER_SIZE = 64 * 1024
+ASYNC_BODY_TIMEOUT = 30
+ASYNC_SEND_BUFFER = 8
+ASYNC_SEND_TIMEOUT = 10
+
+#
+# Database calls made from asyncio code run on a fixed-size pool of
+# threads, so that they don't hold up the event loop while they wait
+# for sqlite. The pool is created when it's first needed.
+#
+DB_THREADS = SERVER_WORKERS
+_db_executor = None
+
+def db_executor():
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DB_THREADS)
+    return _db_executor
+
+def run_in_db_thread(function, *args, **kwargs):
+    """Run a (blocking) function on one of the database threads, returning
+    something which can be awaited for its result
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(db_executor(), functools.partial(function, *args, **kwargs))
+
+async def get_user_async(user_id):
+    return await run_in_db_thread(get_user, user_id)
 
-    start_response(status, headers)
-    return [data.encode("utf-8")]
+async def get_room_async(room_id):
+    return await run_in_db_thread(get_room, room_id)
 
-def run_website():
-    httpd = make_server('', 8000, webapp)
-    print("Serving on port 8000...")
-    httpd.serve_forever()
+async def get_users_async():
+    return await run_in_db_thread(get_users)
+
+async def get_rooms_async():
+    return await run_in_db_thread(get_rooms)
+
+async def get_bookings_async(limit=None, after=None, before=None):
+    return await run_in_db_thread(get_bookings, limit, after, before)
+
+async def get_bookings_for_user_async(user_id, limit=None, after=None, before=None):
+    return await run_in_db_thread(get_bookings_for_user, user_id, limit, after, before)
+
+async def get_bookings_for_room_async(room_id, limit=None, after=None, before=None):
+    return await run_in_db_thread(get_bookings_for_room, room_id, limit, after, before)
+
+async def add_user_to_database_async(name, email_address):
+    return await run_in_db_thread(add_user_to_database, name, email_address)
+
+async def add_room_to_database_async(name, location):
+    return await run_in_db_thread(add_room_to_database, name, location)
+
+async def add_booking_to_database_async(user_id, room_id, booked_on, booked_from=None, booked_to=None):
+    return await run_in_db_thread(add_booking_to_database, user_id, room_id, booked_on, booked_from, booked_to)
+
+def wsgi_environ(method, target, version, headers, body, port):
+    """Build the WSGI environment for one request read by the asyncio
+    server, as wsgiref would for the other servers
+    """
+    path, _, query_string = target.partition("?")
+    environ = {
+        "REQUEST_METHOD" : method,
+        "SCRIPT_NAME" : "",
+        "PATH_INFO" : urllib.parse.unquote(path, "iso-8859-1"),
+        "QUERY_STRING" : query_string,
+        "SERVER_NAME" : "localhost",
+        "SERVER_PORT" : str(port),
+        "SERVER_PROTOCOL" : version,
+        "wsgi.version" : (1, 0),
+        "wsgi.url_scheme" : "http",
+        "wsgi.input" : io.BytesIO(body),
+        "wsgi.errors" : sys.stderr,
+        "wsgi.multithread" : True,
+        "wsgi.multiprocess" : False,
+        "wsgi.run_once" : False,
+    }
+    for name, value in headers.items():
+        key = name.upper().replace("-", "_")
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+        else:
+            environ["HTTP_" + key] = value
+    return environ
+
+class BrowserGone(Exception):
+    pass
+
+def run_webapp(environ, send):
+    """Run the webapp for one request on a database thread, passing each
+    chunk of the page to send() -- which hands it to the event loop to
+    write -- as it's produced. The status and headers are left in the
+    environment for the event loop to pick up.
+    """
+    def start_response(status, headers, exc_info=None):
+        environ["bookings.response"] = (status, headers)
+    body = webapp(environ, start_response)
+    try:
+        for chunk in body:
+            if chunk:
+                send(chunk)
+    finally:
+        body.close()
+
+async def handle_connection(reader, writer, port):
+    """Serve the requests which come in on one connection, keeping it
+    open between requests for as long as the browser wants. While the
+    connection is idle, it's just this coroutine, waiting: no thread
+    is tied up until a request arrives.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), ASYNC_KEEPALIVE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                break
+
+            lines = head.decode("iso-8859-1").split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ")
+            except ValueError:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                break
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            #
+            # The body is read in full before the page sees it, so check
+            # its length here, before reading any of it, rather than
+            # leaving it to parse_form. Only bodies with a Content-Length
+            # are understood.
+            #
+            try:
+                content_length = int(headers.get("content-length") or 0)
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                break
+            if content_length > MAX_FORM_SIZE:
+                writer.write(b"HTTP/1.1 413 Request Entity Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                break
+            if "transfer-encoding" in headers:
+                writer.write(b"HTTP/1.1 411 Length Required\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                break
+            try:
+                body = await asyncio.wait_for(reader.readexactly(content_length), ASYNC_BODY_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                break
+
+            keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            environ = wsgi_environ(method, target, version, headers, body, port)
+            sent = []
+
+            async def send(chunk):
+                if not sent:
+                    status, response_headers = environ["bookings.response"]
+                    head = ["%s %s" % (version, status)]
+                    head.extend("%s: %s" % header for header in response_headers)
+                    if keep_alive:
+                        head.append("Transfer-Encoding: chunked")
+                    else:
+                        head.append("Connection: close")
+                    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("iso-8859-1"))
+                    sent.append(True)
+                if chunk and method != "HEAD":
+                    if keep_alive:
+                        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    else:
+                        writer.write(chunk)
+                await asyncio.wait_for(writer.drain(), ASYNC_SEND_TIMEOUT)
+
+            #
+            # The page is made on a database thread and handed over here a
+            # chunk at a time to be written, with at most ASYNC_SEND_BUFFER
+            # chunks waiting. So the thread (and the snapshot it's reading)
+            # is held up by a slow browser only once it's that far ahead,
+            # and is let go when the browser is given up on.
+            #
+            chunks = asyncio.Queue()
+            room = threading.Semaphore(ASYNC_SEND_BUFFER)
+            gone = threading.Event()
+
+            def send_from_thread(chunk):
+                if not room.acquire(timeout=ASYNC_SEND_TIMEOUT) or gone.is_set():
+                    raise BrowserGone()
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+
+            rendering = asyncio.ensure_future(run_in_db_thread(run_webapp, environ, send_from_thread))
+            rendering.add_done_callback(lambda future: chunks.put_nowait(None))
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    await send(chunk)
+                    room.release()
+            except (ConnectionError, asyncio.TimeoutError):
+                gone.set()
+                room.release()
+                try:
+                    await rendering
+                except Exception:
+                    pass
+                break
+
+            try:
+                rendering.result()
+            except BrowserGone:
+                break
+            except Exception:
+                traceback.print_exc()
+                if not sent:
+                    environ["bookings.response"] = ("500 Internal Server Error", [("Content-type", "text/plain")])
+                    keep_alive = False
+                    await send(b"Internal Server Error")
+                break
+
+            await send(b"")
+            if not keep_alive:
+                break
+            if method != "HEAD":
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+    except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_async(port=SERVER_PORT, backlog=SERVER_BACKLOG):
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, port),
+        port=port,
+        backlog=backlog,
+        limit=ASYNC_MAX_HEADER_SIZE
+    )
+    async with server:
+        await server.serve_forever()
+
+def run_website(mode="single", port=SERVER_PORT, workers=SERVER_WORKERS, backlog=SERVER_BACKLOG):
+    """Serve the website until interrupted. See SERVER_MODES for the
+    different ways of doing that.
+    """
+    global DB_THREADS
+    if mode == "prefork" and not hasattr(os, "fork"):
+        raise RuntimeError("prefork mode isn't available on this platform")
+    if mode != "single":
+        enable_concurrent_access()
+
+    if mode == "async":
+        DB_THREADS = workers
+        print("Serving on port %d (%s)..." % (port, mode))
+        try:
+            asyncio.run(serve_async(port, backlog))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    httpd = make_website_server(mode, port, workers, backlog)
+    print("Serving on port %d (%s)..." % (port, mode))
+    try:
+        if mode == "prefork":
+            serve_preforked(httpd, workers)
+        else:
+            httpd.serve_forever()
+    finally:
+        httpd.server_close()
 
 if __name__ == '__main__':
+    #
+    # python bookings.py import|export users|rooms|bookings <file.csv>
+    #
+    if len(sys.argv) == 4 and sys.argv[1] in ("import", "export"):
+        command, table, filepath = sys.argv[1:]
+        create_database()
+        if command == "import":
+            import_csv(table, filepath)
+        else:
+            export_csv(table, filepath)
+        sys.exit()
+
+    #
+    # python bookings.py schedule <requests.csv>
+    #
+    # Each line of the file is user_id, booked_on, booked_from, booked_to
+    # and, optionally, the ids of preferred rooms separated by spaces.
+    # Whatever couldn't be placed is written out in the same form.
+    #
+    if len(sys.argv) == 3 and sys.argv[1] == "schedule":
+        create_database()
+        with open_csv(sys.argv[2], "r") as f:
+            requests = [
+                row[:4] + [[int(room_id) for room_id in " ".join(row[4:]).split()]]
+                for row in csv.reader(f) if row
+            ]
+        bookings, unplaced = schedule_bookings(
+            [[value or None for value in request] for request in requests]
+        )
+        sys.stderr.write("Booked %d, could not place %d\n" % (len(bookings), len(unplaced)))
+        writer = csv.writer(sys.stdout)
+        for user_id, booked_on, booked_from, booked_to, preferred in unplaced:
+            writer.writerow([user_id, booked_on, booked_from or "", booked_to or "", " ".join(str(room_id) for room_id in preferred or [])])
+        sys.exit()
+
+    #
+    # python bookings.py [single|threaded|pool|prefork [port [workers]]]
+    #
+    mode = sys.argv[1] if len(sys.argv) > 1 else "single"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else SERVER_PORT
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else SERVER_WORKERS
+
     print("About to create database %s" % DATABASE_FILEPATH)
-    create_database()
-    print("About to populate database %s" % DATABASE_FILEPATH)
-    populate_database()
+    if create_database():
+        print("About to populate database %s" % DATABASE_FILEPATH)
+        populate_database()
     print("About to run webserver")
-    run_website()
+    run_website(mode, port, workers)
     print("Finished")
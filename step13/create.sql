@@ -19,6 +19,7 @@ CREATE TABLE
 CREATE TABLE
     bookings
 (
+    id INTEGER PRIMARY KEY NOT NULL,
     user_id INTEGER NOT NULL,
     room_id INTEGER NOT NULL,
     booked_on DATE NOT NULL,
@@ -27,9 +28,144 @@ CREATE TABLE
 )
 ;
 
+CREATE INDEX
+    ix_bookings_room
+ON bookings
+(
+    room_id, booked_on, booked_from
+)
+;
+
+--
+-- Finding which rooms are free on a given day (and at what times)
+-- can be answered from this index alone.
+--
+CREATE INDEX
+    ix_bookings_day
+ON bookings
+(
+    booked_on, room_id, booked_from, booked_to
+)
+;
+
+--
+-- Listings of bookings are paged in order of (booked_on, booked_from,
+-- id), which these indexes (and ix_bookings_room, for a room) give
+-- directly: the id comes for free as the rowid at the end of every
+-- index entry.
+--
+CREATE INDEX
+    ix_bookings_when
+ON bookings
+(
+    booked_on, booked_from
+)
+;
+
+CREATE INDEX
+    ix_bookings_user
+ON bookings
+(
+    user_id, booked_on, booked_from
+)
+;
+
+--
+-- No two bookings of the same room may overlap. A booking with no
+-- start time starts at the beginning of the day and one with no end
+-- time runs to the end of it (so one with neither is all day). The
+-- check finds the room's bookings for that day through ix_bookings_room.
+--
+CREATE TRIGGER
+    tr_bookings_no_overlap_insert
+BEFORE INSERT ON bookings
+WHEN EXISTS (
+    SELECT 1 FROM bookings AS boo
+    WHERE boo.room_id = NEW.room_id
+    AND boo.booked_on = NEW.booked_on
+    AND COALESCE(NULLIF(boo.booked_from, ''), '00:00') < COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+    AND COALESCE(NULLIF(NEW.booked_from, ''), '00:00') < COALESCE(NULLIF(boo.booked_to, ''), '24:00')
+)
+BEGIN
+    SELECT RAISE(ABORT, 'booking conflict');
+END;
+
+CREATE TRIGGER
+    tr_bookings_no_overlap_update
+BEFORE UPDATE OF room_id, booked_on, booked_from, booked_to ON bookings
+WHEN EXISTS (
+    SELECT 1 FROM bookings AS boo
+    WHERE boo.room_id = NEW.room_id
+    AND boo.booked_on = NEW.booked_on
+    AND boo.id <> NEW.id
+    AND COALESCE(NULLIF(boo.booked_from, ''), '00:00') < COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+    AND COALESCE(NULLIF(NEW.booked_from, ''), '00:00') < COALESCE(NULLIF(boo.booked_to, ''), '24:00')
+)
+BEGIN
+    SELECT RAISE(ABORT, 'booking conflict');
+END;
+
+--
+-- A booking must end after it starts: an empty or backwards range
+-- would never overlap anything and would upset the slot bitmaps.
+--
+CREATE TRIGGER
+    tr_bookings_times_insert
+BEFORE INSERT ON bookings
+WHEN COALESCE(NULLIF(NEW.booked_from, ''), '00:00') >= COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+BEGIN
+    SELECT RAISE(ABORT, 'booking times backwards');
+END;
+
+CREATE TRIGGER
+    tr_bookings_times_update
+BEFORE UPDATE OF booked_from, booked_to ON bookings
+WHEN COALESCE(NULLIF(NEW.booked_from, ''), '00:00') >= COALESCE(NULLIF(NEW.booked_to, ''), '24:00')
+BEGIN
+    SELECT RAISE(ABORT, 'booking times backwards');
+END;
+
+--
+-- Times are compared as text, here and in the triggers above, and
+-- read as hours and minutes by v_booking_slots, so only HH:MM times
+-- from 00:00 to 24:00 are let in (or no time at all).
+--
+CREATE TRIGGER
+    tr_bookings_time_format_insert
+BEFORE INSERT ON bookings
+WHEN NOT (
+    COALESCE(NEW.booked_from, '') IN ('', '24:00')
+    OR NEW.booked_from GLOB '[01][0-9]:[0-5][0-9]'
+    OR NEW.booked_from GLOB '2[0-3]:[0-5][0-9]'
+) OR NOT (
+    COALESCE(NEW.booked_to, '') IN ('', '24:00')
+    OR NEW.booked_to GLOB '[01][0-9]:[0-5][0-9]'
+    OR NEW.booked_to GLOB '2[0-3]:[0-5][0-9]'
+)
+BEGIN
+    SELECT RAISE(ABORT, 'booking times unreadable');
+END;
+
+CREATE TRIGGER
+    tr_bookings_time_format_update
+BEFORE UPDATE OF booked_from, booked_to ON bookings
+WHEN NOT (
+    COALESCE(NEW.booked_from, '') IN ('', '24:00')
+    OR NEW.booked_from GLOB '[01][0-9]:[0-5][0-9]'
+    OR NEW.booked_from GLOB '2[0-3]:[0-5][0-9]'
+) OR NOT (
+    COALESCE(NEW.booked_to, '') IN ('', '24:00')
+    OR NEW.booked_to GLOB '[01][0-9]:[0-5][0-9]'
+    OR NEW.booked_to GLOB '2[0-3]:[0-5][0-9]'
+)
+BEGIN
+    SELECT RAISE(ABORT, 'booking times unreadable');
+END;
+
 CREATE VIEW
     v_bookings
 AS SELECT
+    boo.id,
     boo.user_id,
     usr.name AS user_name,
     boo.room_id,
@@ -44,3 +180,350 @@ JOIN users AS usr ON
 JOIN rooms AS roo ON
     roo.id = boo.room_id
 ;
+
+--
+-- Each room's bookings for a day are also kept as a bitmap of the
+-- day's 96 quarter-hours: a bit is set if the room is booked for any
+-- part of that quarter-hour. The first 48 quarter-hours (midnight to
+-- midday) are in early_slots and the rest in late_slots, the first
+-- quarter-hour in the lowest bit. Whether a room is free at a time,
+-- or when it's next free, can then be worked out with a few bitwise
+-- operations. The triggers below keep the bitmaps up to date; they
+-- can be rebuilt from the bookings at any time.
+--
+CREATE TABLE
+    room_day_slots
+(
+    booked_on DATE NOT NULL,
+    room_id INTEGER NOT NULL,
+    early_slots INTEGER NOT NULL DEFAULT 0,
+    late_slots INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (booked_on, room_id)
+) WITHOUT ROWID
+;
+
+CREATE TABLE
+    day_slots
+(
+    slot INTEGER PRIMARY KEY NOT NULL
+)
+;
+
+WITH RECURSIVE slots(slot) AS (
+    SELECT 0 UNION ALL SELECT slot + 1 FROM slots WHERE slot < 95
+)
+INSERT INTO day_slots(slot) SELECT slot FROM slots
+;
+
+--
+-- The quarter-hours each booking covers, from first_slot up to (but
+-- not including) end_slot, and those as bitmaps.
+--
+CREATE VIEW
+    v_booking_slots
+AS SELECT
+    id,
+    room_id,
+    booked_on,
+    first_slot,
+    end_slot,
+    CASE WHEN MIN(end_slot, 48) > first_slot
+        THEN (1 << MIN(end_slot, 48)) - (1 << first_slot)
+        ELSE 0
+    END AS early_mask,
+    CASE WHEN end_slot > MAX(first_slot, 48)
+        THEN (1 << (end_slot - 48)) - (1 << (MAX(first_slot, 48) - 48))
+        ELSE 0
+    END AS late_mask
+FROM (
+    SELECT
+        id,
+        room_id,
+        booked_on,
+        COALESCE(MIN(MAX((
+            CAST(substr(time_from, 1, instr(time_from, ':') - 1) AS INTEGER) * 60 +
+            CAST(substr(time_from, instr(time_from, ':') + 1, 2) AS INTEGER)
+        ) / 15, 0), 96), 0) AS first_slot,
+        COALESCE(MIN(MAX((
+            CAST(substr(time_to, 1, instr(time_to, ':') - 1) AS INTEGER) * 60 +
+            CAST(substr(time_to, instr(time_to, ':') + 1, 2) AS INTEGER) + 14
+        ) / 15, 0), 96), 96) AS end_slot
+    FROM (
+        SELECT
+            id,
+            room_id,
+            booked_on,
+            NULLIF(booked_from, '') AS time_from,
+            NULLIF(booked_to, '') AS time_to
+        FROM
+            bookings
+    )
+)
+;
+
+CREATE TRIGGER
+    tr_bookings_slots_insert
+AFTER INSERT ON bookings
+BEGIN
+    INSERT OR IGNORE INTO room_day_slots(booked_on, room_id) VALUES(NEW.booked_on, NEW.room_id);
+    UPDATE room_day_slots SET
+        early_slots = early_slots | (SELECT early_mask FROM v_booking_slots WHERE id = NEW.id),
+        late_slots = late_slots | (SELECT late_mask FROM v_booking_slots WHERE id = NEW.id)
+    WHERE booked_on = NEW.booked_on AND room_id = NEW.room_id;
+END
+;
+
+--
+-- When a booking is removed or moved, the bitmap for the day it was
+-- on is worked out again from the room's other bookings that day.
+--
+CREATE TRIGGER
+    tr_bookings_slots_delete
+AFTER DELETE ON bookings
+BEGIN
+    UPDATE room_day_slots SET
+        early_slots = (
+            SELECT COALESCE(SUM(1 << slot), 0) FROM day_slots
+            WHERE slot < 48 AND EXISTS (
+                SELECT 1 FROM v_booking_slots AS bs
+                WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                AND bs.first_slot <= slot AND slot < bs.end_slot
+            )
+        ),
+        late_slots = (
+            SELECT COALESCE(SUM(1 << (slot - 48)), 0) FROM day_slots
+            WHERE slot >= 48 AND EXISTS (
+                SELECT 1 FROM v_booking_slots AS bs
+                WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                AND bs.first_slot <= slot AND slot < bs.end_slot
+            )
+        )
+    WHERE booked_on = OLD.booked_on AND room_id = OLD.room_id;
+END
+;
+
+CREATE TRIGGER
+    tr_bookings_slots_update
+AFTER UPDATE OF room_id, booked_on, booked_from, booked_to ON bookings
+BEGIN
+    UPDATE room_day_slots SET
+        early_slots = (
+            SELECT COALESCE(SUM(1 << slot), 0) FROM day_slots
+            WHERE slot < 48 AND EXISTS (
+                SELECT 1 FROM v_booking_slots AS bs
+                WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                AND bs.first_slot <= slot AND slot < bs.end_slot
+            )
+        ),
+        late_slots = (
+            SELECT COALESCE(SUM(1 << (slot - 48)), 0) FROM day_slots
+            WHERE slot >= 48 AND EXISTS (
+                SELECT 1 FROM v_booking_slots AS bs
+                WHERE bs.room_id = OLD.room_id AND bs.booked_on = OLD.booked_on
+                AND bs.first_slot <= slot AND slot < bs.end_slot
+            )
+        )
+    WHERE booked_on = OLD.booked_on AND room_id = OLD.room_id;
+    INSERT OR IGNORE INTO room_day_slots(booked_on, room_id) VALUES(NEW.booked_on, NEW.room_id);
+    UPDATE room_day_slots SET
+        early_slots = early_slots | (SELECT early_mask FROM v_booking_slots WHERE id = NEW.id),
+        late_slots = late_slots | (SELECT late_mask FROM v_booking_slots WHERE id = NEW.id)
+    WHERE booked_on = NEW.booked_on AND room_id = NEW.room_id;
+END
+;
+
+--
+-- A copy of v_bookings kept as a table, with the user's and room's
+-- names stored alongside each booking, so that listing bookings doesn't
+-- have to join to users and rooms every time. The triggers below keep
+-- it in step with bookings, users and rooms. Each index holds every
+-- column, in the order of one of the listings (all bookings, by room,
+-- by user), so a page of bookings is read from the index alone. The id
+-- has to be named to come straight after the time, where the order
+-- needs it.
+--
+CREATE TABLE
+    bookings_read
+(
+    id INTEGER PRIMARY KEY NOT NULL,
+    user_id INTEGER NOT NULL,
+    user_name VARCHAR(200) NOT NULL,
+    room_id INTEGER NOT NULL,
+    room_name VARCHAR(200) NOT NULL,
+    booked_on DATE NOT NULL,
+    booked_from TIME NULL,
+    booked_to TIME NULL
+)
+;
+
+CREATE INDEX
+    ix_bookings_read_when
+ON bookings_read
+(
+    booked_on, booked_from, id, user_id, user_name, room_id, room_name, booked_to
+)
+;
+
+CREATE INDEX
+    ix_bookings_read_room
+ON bookings_read
+(
+    room_id, booked_on, booked_from, id, user_id, user_name, room_name, booked_to
+)
+;
+
+CREATE INDEX
+    ix_bookings_read_user
+ON bookings_read
+(
+    user_id, booked_on, booked_from, id, user_name, room_id, room_name, booked_to
+)
+;
+
+CREATE TRIGGER
+    tr_bookings_read_insert
+AFTER INSERT ON bookings
+BEGIN
+    INSERT INTO bookings_read SELECT * FROM v_bookings WHERE id = NEW.id;
+END
+;
+
+CREATE TRIGGER
+    tr_bookings_read_delete
+AFTER DELETE ON bookings
+BEGIN
+    DELETE FROM bookings_read WHERE id = OLD.id;
+END
+;
+
+CREATE TRIGGER
+    tr_bookings_read_update
+AFTER UPDATE ON bookings
+BEGIN
+    DELETE FROM bookings_read WHERE id = OLD.id;
+    INSERT INTO bookings_read SELECT * FROM v_bookings WHERE id = NEW.id;
+END
+;
+
+CREATE TRIGGER
+    tr_users_read_update
+AFTER UPDATE OF name ON users
+BEGIN
+    UPDATE bookings_read SET user_name = NEW.name WHERE user_id = NEW.id;
+END
+;
+
+CREATE TRIGGER
+    tr_rooms_read_update
+AFTER UPDATE OF name ON rooms
+BEGIN
+    UPDATE bookings_read SET room_name = NEW.name WHERE room_id = NEW.id;
+END
+;
+
+--
+-- v_bookings only has the bookings whose user and room exist, so the
+-- same goes for the copy.
+--
+CREATE TRIGGER
+    tr_users_read_insert
+AFTER INSERT ON users
+BEGIN
+    INSERT OR IGNORE INTO bookings_read SELECT * FROM v_bookings WHERE user_id = NEW.id;
+END
+;
+
+CREATE TRIGGER
+    tr_rooms_read_insert
+AFTER INSERT ON rooms
+BEGIN
+    INSERT OR IGNORE INTO bookings_read SELECT * FROM v_bookings WHERE room_id = NEW.id;
+END
+;
+
+CREATE TRIGGER
+    tr_users_read_delete
+AFTER DELETE ON users
+BEGIN
+    DELETE FROM bookings_read WHERE user_id = OLD.id;
+END
+;
+
+CREATE TRIGGER
+    tr_rooms_read_delete
+AFTER DELETE ON rooms
+BEGIN
+    DELETE FROM bookings_read WHERE room_id = OLD.id;
+END
+;
+
+--
+-- A counter for each of users and rooms, bumped by the triggers below
+-- whenever anything in that table changes. A process keeping copies of
+-- users or rooms in memory can tell from these alone whether they're
+-- still current, without being misled by changes to other tables.
+--
+CREATE TABLE
+    table_versions
+(
+    name VARCHAR(64) PRIMARY KEY NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+)
+;
+
+INSERT INTO table_versions(name) VALUES('users'), ('rooms')
+;
+
+CREATE TRIGGER
+    tr_users_version_insert
+AFTER INSERT ON users
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+END
+;
+
+CREATE TRIGGER
+    tr_users_version_update
+AFTER UPDATE ON users
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+END
+;
+
+CREATE TRIGGER
+    tr_users_version_delete
+AFTER DELETE ON users
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+END
+;
+
+CREATE TRIGGER
+    tr_rooms_version_insert
+AFTER INSERT ON rooms
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'rooms';
+END
+;
+
+CREATE TRIGGER
+    tr_rooms_version_update
+AFTER UPDATE ON rooms
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'rooms';
+END
+;
+
+CREATE TRIGGER
+    tr_rooms_version_delete
+AFTER DELETE ON rooms
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'rooms';
+END
+;
+
+--
+-- The full-text index of bookings, bookings_fts, isn't made here: not
+-- every build of sqlite has FTS5. create_database in bookings.py makes it
+-- (see SEARCH_INDEX_SQL) if it can.
+--